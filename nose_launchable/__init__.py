@@ -1,5 +1 @@
-import sys
-
 from nose_launchable.plugin import Launchable  # noqa: F401
-
-sys.setrecursionlimit(10000)
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+from time import monotonic, sleep, time
+
+from nose_launchable.log import logger
+
+# fcntl is not available on Windows. There, every process runs create() by itself, and the first value written is used.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_DIR_KEY = "LAUNCHABLE_CACHE_DIR"
+
+DEFAULT_CACHE_DIR = ".launchable"
+
+
+# Directory for files kept between runs. A relative LAUNCHABLE_CACHE_DIR is relative to working_dir.
+def get_cache_dir(working_dir=None):
+    return os.path.join(working_dir or os.getcwd(), os.getenv(CACHE_DIR_KEY) or DEFAULT_CACHE_DIR)
+
+
+# Returns None if the file does not exist or cannot be read, so a broken cache only costs a cold run
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.debug("Ignoring a cache file that cannot be read: path: {}, error: {}".format(path, e))
+        return None
+
+
+# Other processes may read the file at any time, so it is replaced in a single rename
+def save_json(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(content, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+# Returns the content of the file at path, and creates it with create() first if it does not exist.
+# Meant for a file shared by processes running at once, e.g. CI shards on a shared volume: only the process that
+# holds a lock on path + ".lock" runs create(), and the others wait for the file it writes.
+# The OS releases the lock of a process that dies, so a waiting process then takes it over.
+# A process still waiting after timeout seconds runs create() by itself, but the file is only ever written once:
+# whoever writes it first wins, and the others return what it wrote, so every process gets the same value.
+def get_or_create(path, create, timeout, interval=0.5):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    value = _read(path)
+    if value is not None:
+        return value
+
+    if fcntl is None:
+        # Still only the first value written is used
+        return _create(path, create)
+
+    # The lock file is never removed, since a process waiting on a removed file would not exclude a new one
+    with open(path + ".lock", "a") as lock:
+        deadline = monotonic() + timeout
+        while not _try_lock(lock):
+            value = _read(path)
+            if value is not None:
+                return value
+
+            if monotonic() >= deadline:
+                logger.warning("Timed out waiting for {}. Creating it in this process".format(path))
+                return _create(path, create)
+
+            sleep(interval)
+
+        try:
+            # Written by the previous owner of the lock right before it was released
+            value = _read(path)
+            if value is None:
+                value = _create(path, create)
+
+            return value
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _create(path, create):
+    value = create()
+
+    tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as f:
+        f.write(value)
+
+    try:
+        # Unlike a rename, a link fails if path exists, so a value another process has published is kept
+        os.link(tmp, path)
+    except FileExistsError:
+        logger.debug("{} was written by another process meanwhile. Using its value".format(path))
+        value = _read(path)
+    except OSError as e:
+        # The file system has no hard links
+        logger.debug("Could not link {}: {}".format(path, e))
+        published = _read(path)
+        if published is not None:
+            value = published
+        else:
+            os.replace(tmp, path)
+    finally:
+        _remove(tmp)
+
+    return value
+
+
+def _try_lock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+
+    return True
+
+
+# The file is only ever created whole, so one that exists is complete even if it is empty
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Subset results kept between runs, so a retried job or a rerun of the same build prunes its suite without
+# asking Launchable again. Entries expire ttl seconds after they were stored, and the least recently used ones
+# are dropped past max_entries.
+class SubsetCache:
+    FILE = "subset.json"
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    # Returns the order stored for key, or None
+    def get(self, key):
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is None:
+            return None
+
+        now = time()
+        if now - entry["created"] > self.ttl:
+            return None
+
+        entry["used"] = now
+        self._save(entries)
+        return entry["order"]
+
+    def put(self, key, order):
+        now = time()
+        entries = self._load()
+        entries[key] = {"created": now, "used": now, "order": order}
+
+        entries = {k: v for k, v in entries.items() if now - v["created"] <= self.ttl}
+        if len(entries) > self.max_entries:
+            kept = sorted(entries, key=lambda k: entries[k]["used"], reverse=True)[:self.max_entries]
+            entries = {k: entries[k] for k in kept}
+
+        self._save(entries)
+
+    def _load(self):
+        content = load_json(self.path)
+        return content if isinstance(content, dict) else {}
+
+    def _save(self, entries):
+        try:
+            save_json(self.path, entries)
+        except OSError as e:
+            logger.debug("Could not save the subset cache: path: {}, error: {}".format(self.path, e))
@@ -0,0 +1,206 @@
+import codecs
+import collections
+import mmap
+import os
+import tempfile
+
+# Chunks are joined once there are this many, so many tiny writes do not pile up as separate strings
+_MAX_CHUNKS = 1024
+
+
+class CaptureBufferFactory:
+    HEAD_SIZE_KEY = "LAUNCHABLE_CAPTURE_HEAD_SIZE"
+    TAIL_SIZE_KEY = "LAUNCHABLE_CAPTURE_TAIL_SIZE"
+
+    SPILL_SIZE_KEY = "LAUNCHABLE_CAPTURE_SPILL_SIZE"
+
+    DEFAULT_HEAD_SIZE = 512 * 1024
+    DEFAULT_TAIL_SIZE = 512 * 1024
+
+    @classmethod
+    def prepare(cls):
+        return cls(cls._get_head_size(), cls._get_tail_size(), cls._get_spill_size())
+
+    @classmethod
+    def _get_head_size(cls):
+        return int(os.getenv(cls.HEAD_SIZE_KEY) or cls.DEFAULT_HEAD_SIZE)
+
+    @classmethod
+    def _get_tail_size(cls):
+        return int(os.getenv(cls.TAIL_SIZE_KEY) or cls.DEFAULT_TAIL_SIZE)
+
+    @classmethod
+    def _get_spill_size(cls):
+        spill_size = os.getenv(cls.SPILL_SIZE_KEY)
+        return int(spill_size) if spill_size else None
+
+    def __init__(self, head_size, tail_size, spill_size=None):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        # If set, output is kept whole and moved to a temp file past this many characters instead of being truncated
+        self.spill_size = spill_size
+
+    def create(self):
+        if self.spill_size is not None:
+            return SpillBuffer(self.spill_size)
+
+        return BoundedBuffer(self.head_size, self.tail_size)
+
+
+# A write-only text buffer that keeps the first head_size and the last tail_size characters written to it.
+# Whatever falls in between is dropped and replaced with a marker, so memory per test stays bounded
+# while the start of the output and the lines right before a failure are kept.
+class BoundedBuffer:
+    def __init__(self, head_size, tail_size):
+        self.head_size = head_size
+        self.tail_size = tail_size
+
+        self._head = []
+        self._head_length = 0
+        self._tail = collections.deque()
+        self._tail_length = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if not data:
+            return
+
+        room = self.head_size - self._head_length
+        if room > 0:
+            self._head.append(data[:room])
+            self._head_length += min(room, len(data))
+            if len(self._head) > _MAX_CHUNKS:
+                self._head = ["".join(self._head)]
+            data = data[room:]
+            if not data:
+                return
+
+        self._tail.append(data)
+        self._tail_length += len(data)
+
+        while self._tail_length > self.tail_size:
+            excess = self._tail_length - self.tail_size
+            first = self._tail[0]
+
+            if len(first) <= excess:
+                self._tail.popleft()
+                self._tail_length -= len(first)
+                self.dropped += len(first)
+            else:
+                self._tail[0] = first[excess:]
+                self._tail_length -= excess
+                self.dropped += excess
+
+        if len(self._tail) > _MAX_CHUNKS:
+            self._tail = collections.deque(["".join(self._tail)])
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        value = "".join(self._head)
+        if self.dropped:
+            value += "\n... ({} characters truncated by nose-launchable) ...\n".format(self.dropped)
+
+        return value + "".join(self._tail)
+
+
+# Output is stored as UTF-8 in temp files. surrogatepass keeps lone surrogates from broken writers round-trippable.
+_ENCODING = "utf-8"
+_ERRORS = "surrogatepass"
+
+# Bytes decoded at a time when a spilled output is read back
+_CHUNK_SIZE = 1024 * 1024
+
+
+# A write-only text buffer that holds output in memory up to spill_size characters and then moves it to
+# an anonymous temp file. getvalue() returns a str while the output is small and a SpilledOutput afterwards,
+# so a queued CaseEvent refers to the file instead of holding the text.
+class SpillBuffer:
+    def __init__(self, spill_size):
+        self.spill_size = spill_size
+
+        self._chunks = []
+        self._length = 0
+        self._file = None
+
+    def write(self, data):
+        if not data:
+            return
+
+        if self._file is not None:
+            self._file.write(data.encode(_ENCODING, _ERRORS))
+            return
+
+        self._chunks.append(data)
+        self._length += len(data)
+
+        if self._length > self.spill_size:
+            self._file = tempfile.TemporaryFile()
+            self._file.write("".join(self._chunks).encode(_ENCODING, _ERRORS))
+            self._chunks = []
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def getvalue(self):
+        if self._file is None:
+            return "".join(self._chunks)
+
+        self._file.flush()
+        return SpilledOutput(self._file, self._file.tell())
+
+
+# Captured output kept in a temp file. The file is closed when the last reference goes away.
+class SpilledOutput:
+    def __init__(self, file, size):
+        self._file = file
+        self.size = size
+
+    # Size in bytes. Every character takes at least one byte, so it is an upper bound of the text length.
+    def __len__(self):
+        return self.size
+
+    # Releases the temp file before the last reference goes away, e.g. once the output is encoded.
+    # The output cannot be read afterwards.
+    def close(self):
+        self._file.close()
+
+    def __str__(self):
+        return "".join(self.chunks())
+
+    # Decoded text in chunks read from a memory-mapped view of the file
+    def chunks(self):
+        if self.size == 0:
+            return
+
+        decoder = codecs.getincrementaldecoder(_ENCODING)(_ERRORS)
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for start in range(0, self.size, _CHUNK_SIZE):
+                text = decoder.decode(view[start:min(start + _CHUNK_SIZE, self.size)])
+                if text:
+                    yield text
+
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    # The text in the first size bytes. A character cut in half at the end is dropped.
+    def head(self, size):
+        size = max(0, min(size, self.size))
+        if size == 0:
+            return ""
+
+        # Without final, the decoder holds back a trailing partial sequence instead of failing on it
+        decoder = codecs.getincrementaldecoder(_ENCODING)(_ERRORS)
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            return decoder.decode(view[:size])
@@ -7,6 +7,7 @@ class CaseEvent:
     TEST_FAILED = 0
     TEST_SKIPPED = 2
 
+    # stdout and stderr are str, or capture.SpilledOutput when the output was moved to a temp file
     def __init__(self, test_path, duration, status, stdout, stderr):
         self.test_path = test_path
         self.duration = duration
@@ -14,6 +15,8 @@ class CaseEvent:
         self.stdout = stdout
         self.stderr = stderr
         self.created_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        # JSON bytes cached by serializer.encode_event. Reset it after changing the fields above.
+        self.encoded = None
 
     def to_body(self):
         serialized_test_path = [t.to_body() for t in self.test_path]
@@ -22,8 +25,8 @@ class CaseEvent:
             "testPath": serialized_test_path,
             "duration": self.duration,
             "status": self.status,
-            "stdout": self.stdout,
-            "stderr": self.stderr,
+            "stdout": str(self.stdout),
+            "stderr": str(self.stderr),
             "data": {"testPath": serialized_test_path},
             "created_at": self.created_at
         }
@@ -1,23 +1,42 @@
+import gzip
+import hashlib
+import json
 import os
 import subprocess
 import shlex
+import threading
+from logging import DEBUG
 
 from requests import Session
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from nose_launchable import cache
+from nose_launchable.cache import SubsetCache, get_cache_dir, get_or_create
 from nose_launchable.log import logger
+from nose_launchable.metrics import metrics
+from nose_launchable.serializer import serialize_events
 from nose_launchable.version import __version__
 
 
 class LaunchableClientFactory:
     BASE_URL_KEY = "LAUNCHABLE_BASE_URL"
     TOKEN_KEY = "LAUNCHABLE_TOKEN"
+    COMPRESSION_KEY = "LAUNCHABLE_UPLOAD_COMPRESSION"
+    COMPRESSION_THRESHOLD_KEY = "LAUNCHABLE_UPLOAD_COMPRESSION_THRESHOLD"
+    NATIVE_SUBSET_KEY = "LAUNCHABLE_NATIVE_SUBSET"
+    SHARED_SUBSET_DIR_KEY = "LAUNCHABLE_SHARED_SUBSET_DIR"
+    SHARED_SUBSET_TIMEOUT_KEY = "LAUNCHABLE_SHARED_SUBSET_TIMEOUT"
+    SUBSET_CACHE_TTL_KEY = "LAUNCHABLE_SUBSET_CACHE_TTL"
+    SUBSET_CACHE_SIZE_KEY = "LAUNCHABLE_SUBSET_CACHE_SIZE"
 
     DEFAULT_BASE_URL = "https://api.mercury.launchableinc.com"
+    DEFAULT_COMPRESSION_THRESHOLD = 1024
+    DEFAULT_SHARED_SUBSET_TIMEOUT = 600
+    DEFAULT_SUBSET_CACHE_SIZE = 32
 
     @classmethod
-    def prepare(cls, build_number, session):
+    def prepare(cls, build_number, session, working_dir=None):
         url, org, wp, token = cls._parse_options()
         strategy = Retry(
             total=3,
@@ -37,7 +56,13 @@ class LaunchableClientFactory:
             _, bn, _, ts = session.split("/")
             context = TestSessionContext(bn, ts)
 
-        return LaunchableClient(url, org, wp, token, http, subprocess, context)
+        return LaunchableClient(url, org, wp, token, http, subprocess, context,
+                                compression=cls._get_compression(),
+                                compression_threshold=cls._get_compression_threshold(),
+                                native_subset=bool(os.getenv(cls.NATIVE_SUBSET_KEY)),
+                                shared_subset_dir=cls._get_shared_subset_dir(),
+                                shared_subset_timeout=cls._get_shared_subset_timeout(),
+                                subset_cache=cls._get_subset_cache(working_dir))
 
     @classmethod
     def _parse_options(cls):
@@ -54,11 +79,59 @@ class LaunchableClientFactory:
     def _get_base_url(cls):
         return os.getenv(cls.BASE_URL_KEY) or cls.DEFAULT_BASE_URL
 
+    @classmethod
+    def _get_compression(cls):
+        compression = os.getenv(cls.COMPRESSION_KEY)
+        if not compression:
+            return None
+
+        if compression.lower() != LaunchableClient.GZIP:
+            raise Exception("%s supports only %s" % (cls.COMPRESSION_KEY, LaunchableClient.GZIP))
+
+        return LaunchableClient.GZIP
+
+    @classmethod
+    def _get_compression_threshold(cls):
+        return int(os.getenv(cls.COMPRESSION_THRESHOLD_KEY) or cls.DEFAULT_COMPRESSION_THRESHOLD)
+
+    @classmethod
+    def _get_shared_subset_dir(cls):
+        shared_subset_dir = os.getenv(cls.SHARED_SUBSET_DIR_KEY)
+        if shared_subset_dir and cache.fcntl is None:
+            logger.warning("File locks are not supported on this platform, so every shard takes the subset by itself "
+                           "and the first one written to %s is used" % cls.SHARED_SUBSET_DIR_KEY)
+
+        return shared_subset_dir
+
+    @classmethod
+    def _get_shared_subset_timeout(cls):
+        return float(os.getenv(cls.SHARED_SUBSET_TIMEOUT_KEY) or cls.DEFAULT_SHARED_SUBSET_TIMEOUT)
+
+    @classmethod
+    def _get_subset_cache(cls, working_dir):
+        ttl = os.getenv(cls.SUBSET_CACHE_TTL_KEY)
+        if not ttl:
+            return None
+
+        size = int(os.getenv(cls.SUBSET_CACHE_SIZE_KEY) or cls.DEFAULT_SUBSET_CACHE_SIZE)
+        return SubsetCache(os.path.join(get_cache_dir(working_dir), SubsetCache.FILE), float(ttl), size)
+
 
 class LaunchableClient:
     CLIENT_NAME = "nose-launchable"
-
-    def __init__(self, base_url, org_name, workspace_name, token, http, process, context):
+    GZIP = "gzip"
+
+    # CLI subset options the subset API supports, and the goal each of them maps to
+    SUBSET_GOALS = {
+        "--target": "subset-by-percentage",
+        "--confidence": "subset-by-confidence",
+        "--time": "subset-by-absolute-time",
+    }
+
+    def __init__(self, base_url, org_name, workspace_name, token, http, process, context,
+                 compression=None, compression_threshold=LaunchableClientFactory.DEFAULT_COMPRESSION_THRESHOLD,
+                 native_subset=False, shared_subset_dir=None,
+                 shared_subset_timeout=LaunchableClientFactory.DEFAULT_SHARED_SUBSET_TIMEOUT, subset_cache=None):
         self.base_url = base_url
         self.org_name = org_name
         self.workspace_name = workspace_name
@@ -67,6 +140,20 @@ class LaunchableClient:
         self.process = process
         self.test_session_context = context
 
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        # Call the subset API over the pooled session instead of running the launchable CLI, which stays as a fallback
+        self.native_subset = native_subset
+        # Split subset shards of a build share the subset id through a file in this directory
+        self.shared_subset_dir = shared_subset_dir
+        self.shared_subset_timeout = shared_subset_timeout
+        self.subset_cache = subset_cache
+
+        # Bytes of serialized event bodies before and after compression. Updated by several uploader threads.
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self._bytes_lock = threading.Lock()
+
     def start(self):
         if not self.test_session_context.registered_test_session():
             return
@@ -88,7 +175,24 @@ class LaunchableClient:
         self.test_session_context.test_session_id = response_body["id"]
 
     def subset(self, test_names, options, target):
+        if self.subset_cache is None:
+            return self._take_subset(test_names, options, target)
+
+        # The key needs every name, so they are not streamed to the command
+        test_names = list(test_names)
+        key = self._subset_cache_key(test_names, options, target)
+
+        order = self.subset_cache.get(key)
+        if order is not None:
+            logger.debug("Subset test order from the cache: {}".format(order))
+            metrics.increment("client.subset_cache_hits")
+            return order
+
+        order = self._take_subset(test_names, options, target)
+        self.subset_cache.put(key, order)
+        return order
 
+    def _take_subset(self, test_names, options, target):
         opts = {}
         if options is not None:
             # split subset
@@ -99,8 +203,19 @@ class LaunchableClient:
         else:
             opts["--target"] = target + "%"
 
+        if self.shared_subset_dir:
+            # Shards splitting the subset locally need the same one, so the first subset written is shared
+            test_names = list(test_names)
+            output = get_or_create(
+                self._shared_subset_path(test_names, opts),
+                lambda: self._subset(test_names, opts),
+                self.shared_subset_timeout,
+            )
+        else:
+            output = self._subset(test_names, opts)
+
         # launchable subset command returns a list of test names splitted by \n
-        order = self._subset(test_names, opts).rstrip("\n").split("\n")
+        order = output.rstrip("\n").split("\n")
 
         logger.debug("Subset test order: {}".format(order))
 
@@ -113,8 +228,23 @@ class LaunchableClient:
         del opts_for_subset["--bin"]
         opts_for_subset["--split"] = ""
 
-        subset_id = self._subset(
-            test_names, opts_for_subset).rstrip("\n")
+        if self.shared_subset_dir:
+            # The file name needs every name, so they are not streamed to the command
+            test_names = list(test_names)
+            subset_id = get_or_create(
+                self._shared_subset_path(test_names, opts_for_subset),
+                lambda: self._subset(test_names, opts_for_subset).rstrip("\n"),
+                self.shared_subset_timeout,
+            )
+        else:
+            subset_id = self._subset(
+                test_names, opts_for_subset).rstrip("\n")
+
+        if self.native_subset:
+            try:
+                return self._split_subset_native(subset_id, opts['--bin'])
+            except Exception as e:
+                logger.warning("Subset API failed, falling back to the launchable CLI: {}".format(e))
 
         split_subset_cmd = ['launchable',
                             'split-subset', '--subset-id', subset_id]
@@ -124,12 +254,13 @@ class LaunchableClient:
 
         logger.debug("Split-Subset command: {}".format(split_subset_cmd))
 
-        proc = self.process.run(
-            split_subset_cmd,
-            encoding='utf-8',
-            stdout=self.process.PIPE,
-            stderr=self.process.PIPE
-        )
+        with metrics.timer("client.split_subset_seconds"):
+            proc = self.process.run(
+                split_subset_cmd,
+                encoding='utf-8',
+                stdout=self.process.PIPE,
+                stderr=self.process.PIPE
+            )
 
         if proc.returncode != 0:
             raise RuntimeError(
@@ -147,6 +278,18 @@ class LaunchableClient:
     """
 
     def _subset(self, test_names, options):
+        if self.native_subset:
+            goal = self._subset_goal(options)
+            if goal is None:
+                logger.debug("Subset options not supported by the subset API: {}".format(options))
+            else:
+                # The API takes every name at once
+                test_names = list(test_names)
+                try:
+                    return self._subset_native(test_names, goal, "--split" in options)
+                except Exception as e:
+                    logger.warning("Subset API failed, falling back to the launchable CLI: {}".format(e))
+
         subset_cmd = ['launchable', 'subset', '--session',
                       self.test_session_context.get_session()]
 
@@ -160,13 +303,17 @@ class LaunchableClient:
 
         logger.debug("Subset command: {}".format(subset_cmd))
 
-        proc = self.process.run(
-            subset_cmd,
-            input="\n".join(test_names),
-            encoding='utf-8',
-            stdout=self.process.PIPE,
-            stderr=self.process.PIPE
-        )
+        if isinstance(test_names, (list, tuple)):
+            with metrics.timer("client.subset_seconds"):
+                proc = self.process.run(
+                    subset_cmd,
+                    input="\n".join(test_names),
+                    encoding='utf-8',
+                    stdout=self.process.PIPE,
+                    stderr=self.process.PIPE
+                )
+        else:
+            proc = self._run_streaming(subset_cmd, test_names)
 
         if proc.returncode != 0:
             raise RuntimeError(
@@ -174,18 +321,166 @@ class LaunchableClient:
 
         return proc.stdout
 
+    # A session registered by this run is new on every retry, so only a session given by the user is part of the key
+    def _subset_cache_key(self, test_names, options, target):
+        context = self.test_session_context
+        session = context.test_session_id if context.session_given else None
+        opts = self._parse_options(options) if options is not None else {"--target": target + "%"}
+
+        key = hashlib.sha256()
+        key.update(json.dumps([context.build_number, session, sorted(opts.items())]).encode("utf-8"))
+        for name in sorted(test_names):
+            key.update(b"\0" + name.encode("utf-8"))
+
+        return key.hexdigest()
+
+    # Shards of the same build asking for the same subset of the same tests get the same path
+    def _shared_subset_path(self, test_names, options):
+        key = hashlib.sha256()
+        key.update(json.dumps([self.test_session_context.build_number, sorted(options.items())]).encode("utf-8"))
+        for name in sorted(test_names):
+            key.update(b"\0" + name.encode("utf-8"))
+
+        return os.path.join(self.shared_subset_dir, "subset-{}".format(key.hexdigest()))
+
+    # Returns the goal of a subset request for the options, or None if the API does not support all of them
+    # or cannot read their values
+    def _subset_goal(self, options):
+        goal = None
+        for k, v in options.items():
+            if k == "--split":
+                continue
+            if k not in self.SUBSET_GOALS or goal is not None:
+                return None
+
+            goal = {"type": self.SUBSET_GOALS[k]}
+            try:
+                if k == "--time":
+                    goal["duration"] = float(v)
+                else:
+                    goal["percentage"] = float(v.rstrip("%")) / 100
+            except ValueError:
+                # e.g. --time 1h30m, which only the CLI reads
+                return None
+
+        return goal
+
+    # Returns what the launchable CLI prints: the ordered names, or the subset id with split
+    def _subset_native(self, test_names, goal, split):
+        url = "{}/intake/organizations/{}/workspaces/{}/subset".format(
+            self.base_url,
+            self.org_name,
+            self.workspace_name,
+        )
+
+        payload = {
+            "testPaths": [[{"type": "file", "name": name}] for name in test_names],
+            "testRunner": "file",
+            "session": {"id": int(self.test_session_context.test_session_id)},
+            "goal": goal,
+        }
+
+        with metrics.timer("client.subset_seconds"):
+            res = self.http.post(url, headers=self._headers(), data=json.dumps(payload).encode("utf-8"))
+        metrics.increment("client.subset_status_{}".format(res.status_code))
+        res.raise_for_status()
+
+        body = res.json()
+        if split:
+            return "subset/{}\n".format(body["subsettingId"])
+
+        return "".join(name + "\n" for name in _file_names(body["testPaths"]))
+
+    def _split_subset_native(self, subset_id, bin):
+        index, count = bin.split("/")
+        url = "{}/intake/organizations/{}/workspaces/{}/{}/slice".format(
+            self.base_url,
+            self.org_name,
+            self.workspace_name,
+            subset_id,
+        )
+
+        payload = {"sliceCount": int(count), "sliceIndex": int(index) - 1}
+
+        with metrics.timer("client.split_subset_seconds"):
+            res = self.http.post(url, headers=self._headers(), data=json.dumps(payload).encode("utf-8"))
+        metrics.increment("client.subset_status_{}".format(res.status_code))
+        res.raise_for_status()
+
+        order = _file_names(res.json()["testPaths"])
+        logger.debug("Split-Subset test order: {}".format(order))
+
+        return order
+
+    # Start the command first and write names to its stdin as test_names yields them,
+    # so the CLI starts up while the names are still being collected.
+    # stdout and stderr are read on other threads meanwhile, so the command never blocks on a full pipe
+    # while this thread blocks on writing to it.
+    def _run_streaming(self, cmd, test_names):
+        proc = self.process.Popen(
+            cmd,
+            stdin=self.process.PIPE,
+            stdout=self.process.PIPE,
+            stderr=self.process.PIPE,
+            encoding='utf-8'
+        )
+
+        output = {}
+        readers = [threading.Thread(target=_drain, args=(stream, output, name), daemon=True)
+                   for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr))]
+        for reader in readers:
+            reader.start()
+
+        try:
+            separator = ""
+            for name in test_names:
+                proc.stdin.write(separator + name)
+                separator = "\n"
+            proc.stdin.close()
+        except BrokenPipeError:
+            # The command exited early. Its output tells why.
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+
+        # Only the wait after the last name is latency added to the test run
+        with metrics.timer("client.subset_seconds"):
+            proc.wait()
+            for reader in readers:
+                reader.join()
+
+        return subprocess.CompletedProcess(cmd, proc.returncode, output.get("stdout"), output.get("stderr"))
+
     def upload_events(self, events):
+        self.upload_payload(serialize_events(events))
+
+    """
+    @param: request_body Serialized events that returned serialize_events function
+    @param: session Test session to upload to. Defaults to the current one
+    """
+
+    def upload_payload(self, request_body, session=None):
         url = "{}/intake/organizations/{}/workspaces/{}/{}/events".format(
             self.base_url,
             self.org_name,
             self.workspace_name,
-            self.test_session_context.get_session(),
+            session or self.test_session_context.get_session(),
         )
 
-        request_body = self._upload_request_body(events)
-        logger.debug("Request body: {}".format(request_body))
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Request body: {}".format(request_body.decode("utf-8")))
+
+        headers = self._headers()
+        data = self._compress(request_body, headers)
 
-        res = self.http.post(url, headers=self._headers(), json=request_body)
+        with metrics.timer("client.upload_seconds"):
+            res = self.http.post(url, headers=headers, data=data)
+        metrics.increment("client.upload_status_{}".format(res.status_code))
         res.raise_for_status()
 
     def finish(self):
@@ -207,8 +502,23 @@ class LaunchableClient:
             'Authorization': 'Bearer {}'.format(self.token)
         }
 
-    def _upload_request_body(self, events):
-        return {"events": [event.to_body() for event in events]}
+    def _compress(self, data, headers):
+        raw_size = len(data)
+
+        if self.compression is not None and raw_size >= self.compression_threshold:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = self.GZIP
+
+        logger.debug("Upload body size: raw: {}, sent: {}".format(raw_size, len(data)))
+
+        with self._bytes_lock:
+            self.raw_bytes += raw_size
+            self.sent_bytes += len(data)
+
+        metrics.observe("client.upload_raw_bytes", raw_size)
+        metrics.observe("client.upload_sent_bytes", len(data))
+
+        return data
 
     def _parse_options(self, option_str):
         args = shlex.split(option_str)
@@ -225,10 +535,28 @@ class LaunchableClient:
         return option
 
 
+def _drain(stream, output, name):
+    output[name] = stream.read()
+
+
+# Names of the file components of test paths returned by the subset API
+def _file_names(test_paths):
+    names = []
+    for test_path in test_paths:
+        for component in test_path:
+            if component["type"] == "file":
+                names.append(component["name"])
+                break
+
+    return names
+
+
 class TestSessionContext:
     def __init__(self, build_number, test_session_id=None):
         self.build_number = build_number
         self.test_session_id = test_session_id
+        # False if the session is registered by this run
+        self.session_given = test_session_id is not None
     
     def get_session(self):
         return "builds/{}/test_sessions/{}".format(self.build_number, self.test_session_id)
@@ -0,0 +1,337 @@
+import ast
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from nose.plugins.manager import NoPlugins
+from nose.selector import Selector, TestAddress
+from nose.util import regex_last_key
+
+from nose_launchable.cache import get_cache_dir, load_json, save_json
+from nose_launchable.log import logger
+
+DISCOVERY_WORKERS_KEY = "LAUNCHABLE_DISCOVERY_WORKERS"
+
+DISCOVERY_CACHE_FILE = "discovery.json"
+
+# Returned by DiscoveryCache.get for files that have to be parsed again
+_MISS = object()
+
+# Starting worker processes costs more than parsing a few files
+_MIN_FILES_PER_WORKER = 16
+
+
+# Test files nose will load for the configured test names, found from paths only so nothing gets imported.
+# It walks directories the way nose's loader does, with the same selection rules, and returns absolute paths
+# in loading order. Returns None if a test name cannot be resolved to a path, since its files are then unknown.
+def discover_test_files(conf):
+    selector = Selector(conf)
+    # Plugins are asked while nose loads tests. Asking them here would also ask us.
+    selector.plugins = NoPlugins()
+
+    files = []
+    for name in conf.testNames or ["."]:
+        path = TestAddress(name, workingDir=conf.workingDir).filename
+        if path is None or not os.path.exists(path):
+            logger.debug("Test name {} cannot be resolved to a path".format(name))
+            return None
+
+        if os.path.isdir(path):
+            files.extend(_walk(path, selector, conf))
+        elif path.endswith(".py"):
+            files.append(path)
+
+    return files
+
+
+def _walk(root, selector, conf):
+    # Depth-first with an explicit stack, matching the order of loader.loadTestsFromDir
+    stack = [iter(_entries(root, conf))]
+    while stack:
+        path = next(stack[-1], None)
+        if path is None:
+            stack.pop()
+            continue
+
+        if os.path.isfile(path):
+            if path.endswith(".py") and selector.wantFile(path):
+                yield path
+        elif os.path.isdir(path):
+            # nose never loads directories starting with an underscore
+            if not os.path.basename(path).startswith("_") and selector.wantDirectory(path):
+                stack.append(iter(_entries(path, conf)))
+
+
+def _entries(directory, conf):
+    entries = os.listdir(directory)
+    entries.sort(key=regex_last_key(conf.testMatch))
+
+    return [os.path.abspath(os.path.join(directory, entry)) for entry in entries if not entry.startswith(".")]
+
+
+# Parse the files with ast and return {path: names of the test classes and functions defined or imported in it}.
+# Selection follows nose's rules for test_match, so a file mapped to an empty list has no tests, the same as an
+# empty leaf in manager.build_index. A file that cannot be parsed maps to None, since nose still reports it.
+# Files are parsed in a process pool with up to workers processes, by default one per core.
+# With a DiscoveryCache, only files changed since it was saved are parsed.
+def scan_test_files(paths, test_match, workers=None, cache=None):
+    paths = list(paths)
+    pattern = test_match.pattern if hasattr(test_match, "pattern") else test_match
+
+    tests = {}
+    if cache is not None:
+        for path in paths:
+            names = cache.get(path)
+            if names is not _MISS:
+                tests[path] = names
+        paths = [path for path in paths if path not in tests]
+        logger.debug("Discovery cache: hits: {}, misses: {}".format(len(tests), len(paths)))
+
+    for path, (digest, names) in _scan_all(paths, pattern, workers).items():
+        if cache is not None and digest is not None:
+            cache.put(path, digest, names)
+        tests[path] = names
+
+    return tests
+
+
+def _scan_all(paths, pattern, workers):
+    if workers is None:
+        workers = int(os.getenv(DISCOVERY_WORKERS_KEY) or os.cpu_count() or 1)
+    workers = min(workers, len(paths) // _MIN_FILES_PER_WORKER)
+
+    # A forked process gets the locks other threads hold at that moment, e.g. of logging, and never sees them
+    # released. Only fork while no other thread runs.
+    if workers > 1 and threading.active_count() > 1:
+        logger.debug("Other threads are running, parsing test files in this process")
+        workers = 1
+
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(paths) // (workers * 4))
+                return dict(zip(paths, executor.map(_scan, paths, [pattern] * len(paths), chunksize=chunksize)))
+        except (OSError, RuntimeError) as e:
+            # e.g. no /dev/shm in a sandbox
+            logger.debug("Could not start discovery workers, parsing in this process: {}".format(e))
+
+    return {path: _scan(path, pattern) for path in paths}
+
+
+# Returns the digest of the source, for DiscoveryCache, and the names of the tests
+def _scan(path, pattern):
+    try:
+        with open(path, "rb") as f:
+            source = f.read()
+    except OSError:
+        return None, None
+
+    try:
+        tree = ast.parse(source, path)
+    except (SyntaxError, ValueError):
+        return _digest(source), None
+
+    return _digest(source), _TestFinder(re.compile(pattern)).find(tree)
+
+
+def _digest(source):
+    return hashlib.sha1(source).hexdigest()
+
+
+# Finds what nose's loader would collect from a module without importing it:
+# functions and classes whose names match testMatch, classes deriving from a base that is not defined in the module
+# (it may be a unittest.TestCase), and names imported into the module, which nose collects as well.
+# Definitions under if, try, with and loop statements count, since the module may run them.
+# __test__ is honoured on the module and on classes. When it cannot be told, a name is taken as a test.
+class _TestFinder:
+    def __init__(self, test_match):
+        self.test_match = test_match
+
+    def find(self, tree):
+        if _declared_test(tree.body) is False:
+            return []
+
+        statements = list(_statements(tree.body))
+        classes = {node.name: node for node in statements if isinstance(node, ast.ClassDef)}
+
+        names = []
+        for node in statements:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if self._matches(node.name):
+                    names.append(node.name)
+            elif isinstance(node, ast.ClassDef):
+                if self._is_test_class(node, classes, set()):
+                    names.append(node.name)
+            elif isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    name = alias.asname or alias.name
+                    # A star import can bring in anything
+                    if name == "*" or self._matches(name):
+                        names.append(name)
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    if isinstance(target, ast.Name) and self._matches(target.id):
+                        names.append(target.id)
+
+        # A name defined in both branches of an if is one test
+        return list(dict.fromkeys(names))
+
+    def _matches(self, name):
+        return not name.startswith("_") and self.test_match.search(name) is not None
+
+    def _is_test_class(self, node, classes, seen):
+        # Like nose's selector, a declared __test__ wins over the name
+        declared = _declared_test(node.body)
+        if declared is not None:
+            return declared
+        if node.name.startswith("_"):
+            return False
+        if self.test_match.search(node.name):
+            return True
+
+        seen.add(node.name)
+        for base in node.bases:
+            if isinstance(base, ast.Name) and base.id == "object":
+                continue
+            if isinstance(base, ast.Name) and base.id in classes:
+                if base.id not in seen and self._is_test_class(classes[base.id], classes, seen):
+                    return True
+                continue
+            # Defined elsewhere, so it may be a TestCase
+            return True
+
+        return False
+
+
+# Statements of body and of the blocks nested in it, in source order. Function and class bodies are not entered.
+def _statements(body):
+    stack = [iter(body)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            continue
+
+        yield node
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+
+        children = []
+        for field in ("body", "handlers", "cases", "orelse", "finalbody"):
+            block = getattr(node, field, None)
+            if not isinstance(block, list):
+                continue
+            for child in block:
+                # Except handlers and match cases hold their statements in body
+                children.extend([child] if isinstance(child, ast.stmt) else child.body)
+        if children:
+            stack.append(iter(children))
+
+
+# The value of __test__ set in body: True, False, or None if it is not set.
+# A value that is not a literal, or one set under a condition, may be true.
+def _declared_test(body):
+    declared = None
+    for node in _statements(body):
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets = [node.target]
+        else:
+            continue
+        if not any(isinstance(target, ast.Name) and target.id == "__test__" for target in targets):
+            continue
+
+        if not any(node is statement for statement in body):
+            return True
+        try:
+            # literal_eval reads True and False the same on every Python version
+            declared = bool(ast.literal_eval(node.value))
+        except (ValueError, TypeError, SyntaxError):
+            return True
+
+    return declared
+
+
+# Results of scan_test_files kept in the cache directory between runs.
+# An entry is valid while the file keeps its mtime and size. A fresh checkout changes every mtime, so a file whose
+# mtime changed but whose size did not is hashed and still hits if its content is the same.
+# The whole cache is dropped when testMatch changes. Only files looked up in this run are saved,
+# so deleted files do not pile up.
+class DiscoveryCache:
+    VERSION = 1
+
+    def __init__(self, path, test_match):
+        self.path = path
+        self.test_match = test_match.pattern if hasattr(test_match, "pattern") else test_match
+
+        self._files = {}
+        self._seen = {}
+        self._keys = {}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, test_match, working_dir=None):
+        path = os.path.join(get_cache_dir(working_dir), DISCOVERY_CACHE_FILE)
+        cache = cls(path, test_match)
+
+        content = load_json(path)
+        if content and content.get("version") == cls.VERSION and content.get("testMatch") == cache.test_match:
+            cache._files = content.get("files", {})
+
+        return cache
+
+    # Entries are [mtime_ns, size, digest, names]
+    def get(self, path):
+        key = _stat_key(path)
+        # put() stores the key taken before the file was parsed, so an edit made meanwhile is not hidden
+        self._keys[path] = key
+
+        entry = self._files.get(path)
+        if key is None or entry is None or entry[1] != key[1]:
+            return _MISS
+
+        if entry[0] != key[0]:
+            try:
+                with open(path, "rb") as f:
+                    digest = _digest(f.read())
+            except OSError:
+                return _MISS
+
+            if digest != entry[2]:
+                return _MISS
+
+            entry = key + entry[2:]
+            self._dirty = True
+
+        self._seen[path] = entry
+        return entry[3]
+
+    def put(self, path, digest, names):
+        key = self._keys.get(path)
+        if key is None:
+            return
+
+        self._seen[path] = key + [digest, names]
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty and len(self._seen) == len(self._files):
+            return
+
+        try:
+            save_json(self.path, {"version": self.VERSION, "testMatch": self.test_match, "files": self._seen})
+        except OSError as e:
+            logger.debug("Could not save the discovery cache: path: {}, error: {}".format(self.path, e))
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
@@ -0,0 +1,258 @@
+import math
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from time import monotonic, time
+
+from nose_launchable.case_event import CaseEvent
+from nose_launchable.log import logger
+from nose_launchable.test_path_component import TestPathComponent
+
+HISTORY_FILE_KEY = "LAUNCHABLE_HISTORY_FILE"
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INTERVAL = 1
+
+# Rows are looked up in chunks to stay below SQLite's limit of bound parameters
+_CHUNK_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    test_path TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    m2 REAL NOT NULL,
+    min REAL,
+    max REAL,
+    passed INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    skipped INTEGER NOT NULL,
+    last_status INTEGER NOT NULL,
+    last_duration REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_file ON tests (file);
+"""
+
+_COLUMNS = ("test_path", "file", "runs", "mean", "m2", "min", "max", "passed", "failed", "skipped",
+            "last_status", "last_duration", "updated_at")
+
+
+class HistoryFactory:
+    @classmethod
+    def prepare(cls):
+        path = os.getenv(HISTORY_FILE_KEY)
+        if not path:
+            return None
+
+        return HistoryRecorder(path)
+
+
+# Test durations and outcomes across runs in an SQLite file. There is one row per test path with rolling
+# statistics (Welford's mean and sum of squared deviations), so the file does not grow with the number of runs.
+# Durations of skipped tests are not part of the statistics.
+class History:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        # Another process may be writing the same file, e.g. parallel jobs sharing a cache.
+        # Transactions are begun explicitly, so that rows cannot change between reading and writing them.
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.executescript(_SCHEMA)
+
+    # results are (test_path, status, duration) tuples. They are merged in one transaction.
+    def add(self, results):
+        now = time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._load({format_test_path(test_path) for test_path, _, _ in results})
+
+            for test_path, status, duration in results:
+                key = format_test_path(test_path)
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = {"test_path": key, "file": _file_name(test_path), "runs": 0, "mean": 0.0,
+                                       "m2": 0.0, "min": None, "max": None, "passed": 0, "failed": 0, "skipped": 0}
+
+                if status == CaseEvent.TEST_SKIPPED:
+                    row["skipped"] += 1
+                else:
+                    row["passed" if status == CaseEvent.TEST_PASSED else "failed"] += 1
+
+                    row["runs"] += 1
+                    delta = duration - row["mean"]
+                    row["mean"] += delta / row["runs"]
+                    row["m2"] += delta * (duration - row["mean"])
+                    row["min"] = duration if row["min"] is None else min(row["min"], duration)
+                    row["max"] = duration if row["max"] is None else max(row["max"], duration)
+
+                row["last_status"] = status
+                row["last_duration"] = duration
+                row["updated_at"] = now
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tests ({}) VALUES ({})".format(
+                    ", ".join(_COLUMNS), ", ".join("?" * len(_COLUMNS))),
+                [tuple(row[c] for c in _COLUMNS) for row in rows.values()])
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        self._db.execute("COMMIT")
+
+    # {file name: expected duration of all of its tests}
+    def file_durations(self):
+        return dict(self._db.execute("SELECT file, SUM(mean) FROM tests WHERE runs > 0 GROUP BY file"))
+
+    # [(test path, runs, mean, standard deviation, failed)] of the tests with the longest mean duration
+    def slowest(self, limit):
+        return [(test_path, runs, mean, math.sqrt(m2 / (runs - 1)) if runs > 1 else 0.0, failed)
+                for test_path, runs, mean, m2, failed in self._db.execute(
+                    "SELECT test_path, runs, mean, m2, failed FROM tests WHERE runs > 0 ORDER BY mean DESC LIMIT ?",
+                    (limit,))]
+
+    def close(self):
+        self._db.close()
+
+    def _load(self, keys):
+        keys = list(keys)
+        rows = {}
+        for i in range(0, len(keys), _CHUNK_SIZE):
+            chunk = keys[i:i + _CHUNK_SIZE]
+            cursor = self._db.execute(
+                "SELECT {} FROM tests WHERE test_path IN ({})".format(
+                    ", ".join(_COLUMNS), ", ".join("?" * len(chunk))),
+                chunk)
+            for values in cursor:
+                rows[values[0]] = dict(zip(_COLUMNS, values))
+
+        return rows
+
+
+# Feeds test results to a History from a background thread, so the test run only pays for a queue put.
+# Results are written in batches of up to batch_size, at most interval seconds after the first one arrives.
+class HistoryRecorder:
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._queue = queue.Queue()
+        # Set when the history cannot be opened, so results are no longer queued for nothing
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="launchable-history")
+
+    def start(self):
+        self._thread.start()
+
+    def record(self, event):
+        if self._failed:
+            return
+
+        self._queue.put((event.test_path, event.status, event.duration))
+
+    def join(self, timeout=None):
+        if self._failed:
+            return
+
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Test history was not fully written to {}".format(self.path))
+
+    def _run(self):
+        # SQLite connections belong to the thread that opened them
+        try:
+            history = History(self.path)
+        except Exception as e:
+            logger.warning("Could not open the test history {}: {}".format(self.path, e))
+            self._failed = True
+            # Results recorded before the flag was seen
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return
+
+        try:
+            done = False
+            while not done:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                batch = [item]
+                deadline = monotonic() + self.interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+
+                try:
+                    history.add(batch)
+                except sqlite3.Error as e:
+                    logger.warning("Could not write the test history {}: {}".format(self.path, e))
+        finally:
+            history.close()
+
+
+# {file name: expected duration of all of its tests} from the history at path, or {} if there is none yet
+def load_file_durations(path):
+    if not path or not os.path.exists(path):
+        return {}
+
+    try:
+        history = History(path)
+        try:
+            return history.file_durations()
+        finally:
+            history.close()
+    except sqlite3.Error as e:
+        logger.warning("Could not read the test history {}: {}".format(path, e))
+        return {}
+
+
+# The test path in the text form of the Launchable CLI, e.g. file=tests/test_a.py#class=TestA#testcase=test_a
+def format_test_path(test_path):
+    return "#".join("{}={}".format(c.type, c.name) for c in test_path)
+
+
+def _file_name(test_path):
+    for c in test_path:
+        if c.type == TestPathComponent.FILE_TYPE:
+            return c.name
+    return ""
+
+
+# Entry point of the nose-launchable-history command, which prints the slowest tests
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    path = argv[0] if argv else os.getenv(HISTORY_FILE_KEY)
+    limit = int(argv[1]) if len(argv) > 1 else 20
+    if not path or not os.path.exists(path):
+        sys.stderr.write("Usage: nose-launchable-history [history file] [limit] (or set {})\n".format(
+            HISTORY_FILE_KEY))
+        return 1
+
+    history = History(path)
+    try:
+        for test_path, runs, mean, stdev, failed in history.slowest(limit):
+            sys.stdout.write("{:10.3f}s  +/-{:.3f}s  runs: {}  failed: {}  {}\n".format(
+                mean, stdev, runs, failed, test_path))
+    finally:
+        history.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
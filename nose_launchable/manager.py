@@ -1,5 +1,6 @@
 import os
 from inspect import isfunction, ismethod
+from logging import DEBUG
 from types import ModuleType
 
 from nose.case import Test
@@ -11,52 +12,99 @@ from nose.util import test_address
 from nose_launchable.log import logger
 from nose_launchable.test_path_component import TestPathComponent
 
+# Name of the leaves of tests that failed to load
+FAILURE_NAME = "failure"
+
+# Returned by next() once the children of a suite are exhausted
+_END = object()
+
+
+# Names of the tests in a suite tree and where they are, collected in one traversal
+class TestIndex:
+    def __init__(self):
+        # Names of non-empty leaves in traversal order
+        self.names = []
+        # name -> [(leaf, ancestors from the root)], including empty leaves so that subset can keep them
+        self.leaves = {}
+
+
+# Walk a test tree once and return its TestIndex
+# on_name is called with each name as soon as it is found, before the rest of the tree is loaded
+def build_index(test, on_name=None):
+    index = TestIndex()
+    # Formatting suites is costly on large trees, so skip it unless it is logged
+    debug = logger.isEnabledFor(DEBUG)
+
+    def visit(suite, ancestors):
+        if debug:
+            logger.debug("Parsing a test tree: suite: {}".format(suite))
+        if not _is_leaf(suite):
+            return False
+
+        name = _leaf_name(suite)
+        index.leaves.setdefault(name, []).append((suite, ancestors))
+        if not is_empty(suite):
+            index.names.append(name)
+            if on_name is not None:
+                on_name(name)
+
+        return True
+
+    if not visit(test, ()):
+        # Depth-first with an explicit stack. Each frame pulls the children of a suite one by one, so subtrees
+        # are loaded in the same order as a recursive walk would load them.
+        stack = [(test, iter(test), [], (test,))]
+        while stack:
+            suite, children, materialized, chain = stack[-1]
+
+            child = next(children, _END)
+            if child is _END:
+                # Access to _tests is through a generator, so iteration is not repeatable by default
+                suite._tests = materialized
+                stack.pop()
+                continue
 
-# Parse tests and return a list of test names
-def get_test_names(test):
-    test_names = []
-
-    def dfs(suite):
-        logger.debug("Parsing a test tree: suite: {}".format(suite))
-        if _is_leaf(suite):
-            if not is_empty(suite):
-                test_names.append(_get_test_name(suite))
+            materialized.append(child)
+            if not visit(child, chain):
+                stack.append((child, iter(child), [], chain + (child,)))
 
-            return suite
+    logger.debug("Test names: {}".format(index.names))
+    return index
 
-        # Access to _tests is through a generator, so iteration is not repeatable by default
-        suite._tests = [dfs(t) for t in suite]
-        return suite
 
-    dfs(test)
-    logger.debug("Test names: {}".format(test_names))
-    return test_names
+# Parse tests and return a list of test names
+def get_test_names(test):
+    return build_index(test).names
 
 
 # Check if the test contains any test cases
 # If a use uses the Attrib plugin, the file could be empty
 def is_empty(test):
-    empty = True
-
-    def dfs(suite):
-        nonlocal empty
+    empty = _has_test_case(test) is False
 
-        # Exit earlier since we already know the test contains at least one test case
-        if not empty:
-            return suite
+    if empty:
+        stack = [(test, iter(test), [])]
+        while stack:
+            suite, children, materialized = stack[-1]
+
+            child = next(children, _END)
+            if child is _END:
+                suite._tests = materialized
+                stack.pop()
+                continue
 
-        context = getattr(suite, "context", None)
-        # 1. If type(suite) is Test, the search reaches at the bottom
-        # 2. If context is function or method, the search should stop there to avoid executing it.
-        #    It is most likely a test generator.
-        if type(suite) is Test or isfunction(context) or ismethod(context):
-            empty = False
-            return suite
+            materialized.append(child)
+            if _has_test_case(child):
+                empty = False
+                break
 
-        suite._tests = [dfs(t) for t in suite]
-        return suite
+            stack.append((child, iter(child), []))
 
-    dfs(test)
+        # Exit earlier since we already know the test contains at least one test case,
+        # but keep the remaining siblings on every level as they are
+        for suite, children, materialized in reversed(stack):
+            materialized.extend(children)
+            suite._tests = materialized
 
     if empty:
         logger.debug("Suite {} is empty".format(test))
@@ -64,34 +112,60 @@ def is_empty(test):
     return empty
 
 
-# Subset tests based on the given order
-def subset(test, target_tests):
-    def dfs(suite):
-        logger.debug("Subsetting a test tree: suite: {}".format(suite))
-        if _is_leaf(suite):
-            name = _get_test_name(suite)
-            is_target = name in target_tests
-
-            logger.debug("A leaf node: is_target: {}, suite: {}".format(is_target, suite))
-            return is_target, suite
-
-        cases = []
-
-        for t in suite:
-            is_target, c = dfs(t)
+def _has_test_case(suite):
+    context = getattr(suite, "context", None)
+    # 1. If type(suite) is Test, the search reaches at the bottom
+    # 2. If context is function or method, the search should stop there to avoid executing it.
+    #    It is most likely a test generator.
+    return type(suite) is Test or isfunction(context) or ismethod(context)
 
-            if not is_target:
-                continue
 
-            cases.append(c)
+# Subset tests based on the given order
+# If target_tests is a sequence, suites on every level are reordered so that the test ranked first runs first.
+# A set keeps the discovery order.
+# Pass the index built for get_test_names to skip walking the tree and computing names again
+def subset(test, target_tests, index=None):
+    if index is None:
+        index = build_index(test)
+
+    ordered = not isinstance(target_tests, (set, frozenset))
+
+    # name -> rank in the subset. A name listed twice keeps its first rank.
+    ranks = {}
+    for name in target_tests:
+        ranks.setdefault(name, len(ranks))
+
+    # Mark targeted leaves and their ancestors with the best rank below them.
+    # Names are visited from the best rank, so an ancestor already marked by another leaf has a better rank
+    # and the walk up can stop there.
+    kept = {}
+    for name, rank in sorted(ranks.items(), key=lambda item: item[1]):
+        for leaf, ancestors in index.leaves.get(name, ()):
+            kept.setdefault(id(leaf), rank)
+            for suite in reversed(ancestors):
+                if id(suite) in kept:
+                    break
+                kept[id(suite)] = rank
+
+    debug = logger.isEnabledFor(DEBUG)
+
+    # Only marked suites are visited, and their order does not matter
+    stack = [test]
+    while stack:
+        suite = stack.pop()
+        if _is_leaf(suite):
+            continue
 
+        cases = [t for t in suite if id(t) in kept]
+        if ordered:
+            # sort() is stable, so tests with the same rank stay in discovery order
+            cases.sort(key=lambda t: kept[id(t)])
         suite._tests = cases
 
-        is_target = len(cases) != 0
-        logger.debug("A non-leaf node: is_target: {}, suite: {}".format(is_target, suite))
-        return is_target, suite
+        if debug:
+            logger.debug("A non-leaf node: is_target: {}, suite: {}".format(len(cases) != 0, suite))
+        stack.extend(cases)
 
-    dfs(test)
     return test
 
 
@@ -119,11 +193,27 @@ def _get_test_name(suite):
     if not _is_leaf(suite):
         raise RuntimeError("_get_test_name method should run only against a leaf. suite: {}".format(suite))
 
+    return _leaf_name(suite)
+
+
+def _leaf_name(suite):
     if suite.context is Failure:
-        return "failure"
+        return FAILURE_NAME
 
     file_path, _, _ = test_address(suite.context)
-    return os.path.relpath(file_path)
+    return _relpath(file_path)
+
+
+# Every test in a file asks for the same path, so paths are computed once per file.
+# They are relative to the working directory at the first call, so a test changing it does not change the names.
+_relpaths = {}
+
+
+def _relpath(file_path):
+    path = _relpaths.get(file_path)
+    if path is None:
+        path = _relpaths[file_path] = os.path.relpath(file_path)
+    return path
 
 
 # Return testPath like [{"type": "file", "name": "file_path"}, {"type": "testcase", "name": "function_name"}]
@@ -131,7 +221,7 @@ def get_test_path(test):
     test_path = []
 
     file_path, _, _ = test_address(test.test)
-    test_path.append(TestPathComponent(TestPathComponent.FILE_TYPE, os.path.relpath(file_path)))
+    test_path.append(TestPathComponent(TestPathComponent.FILE_TYPE, _relpath(file_path)))
 
     head, tail = id_split(test.test.id())
 
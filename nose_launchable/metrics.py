@@ -0,0 +1,93 @@
+import json
+import math
+import threading
+from contextlib import contextmanager
+from logging import DEBUG
+from time import monotonic
+
+from nose_launchable.log import logger
+
+METRICS_FILE_KEY = "LAUNCHABLE_METRICS_FILE"
+
+PERCENTILES = (50, 90, 99)
+
+
+# Process-wide registry of what the plugin costs: counters, histograms of samples and time series of gauges.
+# It is written from the uploader threads too, so every update takes the lock. Updates happen per batch,
+# per request or per subset call, never per test.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._started = monotonic()
+            self._counters = {}
+            self._histograms = {}
+            self._series = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            self._histograms.setdefault(name, []).append(value)
+
+    # Record the current value of a gauge such as a queue depth
+    def record(self, name, value):
+        with self._lock:
+            self._series.setdefault(name, []).append((round(monotonic() - self._started, 3), value))
+
+    @contextmanager
+    def timer(self, name):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started)
+
+    def report(self):
+        with self._lock:
+            return {
+                "elapsed": monotonic() - self._started,
+                "counters": dict(self._counters),
+                "histograms": {name: summarize(values) for name, values in self._histograms.items()},
+                "series": {name: list(values) for name, values in self._series.items()},
+            }
+
+    # Write the report to path, and to the debug log when LAUNCHABLE_DEBUG is set
+    def dump(self, path=None):
+        if not path and not logger.isEnabledFor(DEBUG):
+            return
+
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+
+        if path:
+            with open(path, "w") as f:
+                f.write(report)
+
+        logger.debug("Metrics: {}".format(report))
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+
+    ordered = sorted(values)
+    summary = {
+        "count": len(ordered),
+        "sum": sum(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+    }
+
+    for p in PERCENTILES:
+        # nearest-rank percentile
+        summary["p{}".format(p)] = ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return summary
+
+
+metrics = Metrics()
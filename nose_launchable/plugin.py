@@ -1,6 +1,5 @@
 import os
 import sys
-from io import StringIO
 from time import time
 import unittest
 
@@ -9,14 +8,33 @@ from nose.plugins.capture import Capture
 from nose.plugins.xunit import Tee
 from nose.plugins.skip import SkipTest
 
+from nose_launchable.capture import CaptureBufferFactory
 from nose_launchable.case_event import CaseEvent
 from nose_launchable.client import LaunchableClientFactory
+from nose_launchable.discovery import DiscoveryCache, discover_test_files, scan_test_files
+from nose_launchable.history import HistoryFactory, HISTORY_FILE_KEY, load_file_durations
 from nose_launchable.log import logger
-from nose_launchable.manager import get_test_names, subset, get_test_path
+from nose_launchable.manager import build_index, subset, get_test_path, FAILURE_NAME
+from nose_launchable.metrics import metrics, METRICS_FILE_KEY
+from nose_launchable.prefetch import SubsetPrefetch
+from nose_launchable.profiler import profiler
 from nose_launchable.protecter import protect, handleError
+from nose_launchable.splitter import parse_bin, split
 from nose_launchable.uploader import UploaderFactory
 
 BUILD_NUMBER_KEY = "LAUNCHABLE_BUILD_NUMBER"
+CAPTURE_POLICY_KEY = "LAUNCHABLE_CAPTURE_POLICY"
+CAPTURE_SOURCE_KEY = "LAUNCHABLE_CAPTURE_SOURCE"
+SUBSET_EARLY_KEY = "LAUNCHABLE_SUBSET_EARLY"
+LOCAL_SPLIT_KEY = "LAUNCHABLE_LOCAL_SPLIT"
+
+# Which test results keep their captured stdout/stderr
+CAPTURE_ALL = "all"
+CAPTURE_FAILURES = "failures"
+
+# Where stdout comes from: our own Tee, or the buffer of nose's Capture plugin when it is enabled
+CAPTURE_SOURCE_TEE = "tee"
+CAPTURE_SOURCE_NOSE = "nose"
 
 
 class Launchable(Plugin):
@@ -31,6 +49,24 @@ class Launchable(Plugin):
         self._capture_stack = []
         self._currentStdout = None
         self._currentStderr = None
+        # When nose's Capture plugin is enabled and either the nose source or the failures policy is chosen,
+        # stdout is read from nose instead of being captured a second time
+        self._noseCapture = None
+        self._stdoutFromNose = False
+        self._prefetch = None
+        self._history = None
+        self._uploaderStarted = False
+        # (index, count) of the bin this shard runs with --launchable-local-split
+        self.local_split = None
+        # Set when the subset is taken before tests are loaded. Paths are absolute.
+        self._early_names = None
+        self._early_targets = None
+        self._early_kept = []
+        self._candidate_files = set()
+        self._candidate_dirs = set()
+        self._loaded_files = set()
+        self._target_files = set()
+        self._target_dirs = set()
 
     def options(self, parser, env):
         super(Launchable, self).options(parser, env=env)
@@ -46,9 +82,29 @@ class Launchable(Plugin):
         parser.add_option("--launchable-subset-options", action='store', dest="subset_options",
                           help="Launchable CLI subset command options")
 
+        parser.add_option("--launchable-subset-early", action='store_true', dest="subset_early",
+                          default=bool(env.get(SUBSET_EARLY_KEY)),
+                          help="Get the subset from test file paths before nose loads tests, "
+                               "so test files outside of it are never imported [%s]" % SUBSET_EARLY_KEY)
+
+        parser.add_option("--launchable-local-split", action='store', type='string', dest="local_split",
+                          default=env.get(LOCAL_SPLIT_KEY),
+                          help="Run only the given bin, e.g. 2/5, of test files split by their durations "
+                               "in the local test history [%s]" % LOCAL_SPLIT_KEY)
+
         parser.add_option("--launchable-record-only", action='store_true', dest="record_only_enabled",
                           help="Enable Launchable recording")
 
+        parser.add_option("--launchable-capture-policy", action='store', type='choice', dest="capture_policy",
+                          choices=[CAPTURE_ALL, CAPTURE_FAILURES], default=env.get(CAPTURE_POLICY_KEY) or CAPTURE_ALL,
+                          help="Report captured stdout/stderr of all tests or of failed tests only [%s]"
+                          % CAPTURE_POLICY_KEY)
+        parser.add_option("--launchable-capture-source", action='store', type='choice', dest="capture_source",
+                          choices=[CAPTURE_SOURCE_TEE, CAPTURE_SOURCE_NOSE],
+                          default=env.get(CAPTURE_SOURCE_KEY) or CAPTURE_SOURCE_TEE,
+                          help="Read stdout from nose's Capture plugin instead of capturing it again. "
+                               "Falls back to capturing when nose does not capture (-s) [%s]" % CAPTURE_SOURCE_KEY)
+
     def configure(self, options, conf):
         super(Launchable, self).configure(options, conf)
 
@@ -59,6 +115,10 @@ class Launchable(Plugin):
         session = options.test_session
         self.subset_target = options.subset_target
         self.subset_options = options.subset_options
+        self.subset_early = getattr(options, "subset_early", False) or False
+        self.local_split = None
+        self.capture_policy = getattr(options, "capture_policy", None) or CAPTURE_ALL
+        self.capture_source = getattr(options, "capture_source", None) or CAPTURE_SOURCE_TEE
 
         if not (self.subset_enabled or self.record_only_enabled):
             # we didn't get activated
@@ -81,9 +141,29 @@ class Launchable(Plugin):
             logger.warning("Please specify either --launchable-subset-target or --launchable-subset-options flag")
             return
 
+        local_split = getattr(options, "local_split", None)
+        if local_split:
+            try:
+                self.local_split = parse_bin(local_split)
+            except ValueError:
+                logger.warning("Please specify --launchable-local-split as <index>/<count>, e.g. 2/5")
+                return
+
+            if self.subset_options is not None and "--bin" in self.subset_options:
+                logger.warning("Please specify either --launchable-local-split or --bin in --launchable-subset-options")
+                return
+
+            # Bins cover the suite only if every shard splits the same subset
+            if self.subset_enabled and not os.getenv(LaunchableClientFactory.SHARED_SUBSET_DIR_KEY):
+                logger.warning("Please set %s to use --launchable-local-split with --launchable-subset"
+                               % LaunchableClientFactory.SHARED_SUBSET_DIR_KEY)
+                return
+
         try:
-            self._client = LaunchableClientFactory.prepare(build_number, session)
+            self._client = LaunchableClientFactory.prepare(build_number, session, conf.workingDir)
             self._uploader = UploaderFactory.prepare(self._client)
+            self._history = HistoryFactory.prepare()
+            self._buffers = CaptureBufferFactory.prepare()
         except Exception as e:
             handleError(e)
             return
@@ -93,42 +173,106 @@ class Launchable(Plugin):
 
     @protect
     def begin(self):
-        self._client.start()
-        self._uploader.start()
+        metrics.reset()
+        profiler.reset()
+        self._started = time()
+        self._noseCapture = self._findNoseCapture()
+        self._stdoutFromNose = self._noseCapture is not None and (
+            self.capture_source == CAPTURE_SOURCE_NOSE or self.capture_policy == CAPTURE_FAILURES)
+
+        # The session and the subset are taken in the background while nose collects tests
+        self._prefetch = SubsetPrefetch(self._client, self.subset_options, self.subset_target, self.subset_enabled)
+
+        # Test files are parsed in forked processes, so this happens before any of our threads is started
+        if self.subset_enabled and self.subset_early:
+            self._subsetEarly()
+
+        self._prefetch.start()
+        if self._history is not None:
+            self._history.start()
+        self._uploaderStarted = False
+
+    # Called by nose's selector while it loads tests. None leaves the decision to nose.
+    def wantFile(self, file):
+        self._joinEarlySubset()
+
+        path = os.path.abspath(file)
+        if path in self._candidate_files and path not in self._target_files:
+            return False
+        return None
+
+    def wantDirectory(self, dirname):
+        self._joinEarlySubset()
+
+        path = os.path.abspath(dirname)
+        if path in self._candidate_dirs and path not in self._target_dirs:
+            return False
+        return None
 
     @protect
     def prepareTest(self, test):
-        if self.subset_enabled:
+        try:
+            if self.subset_enabled:
+                self._subsetTest(test)
+                return test
+
+            if self.local_split is not None:
+                self._splitTest(test)
+                return test
+        except Exception:
+            # The split needs only the names and the history, so shards still share the tests without the subset
+            if self.subset_enabled and self.local_split is not None:
+                self._splitTest(test)
+            raise
+        finally:
+            self._startUploader()
+
+    def _subsetTest(self, test):
+        self._joinEarlySubset()
+
+        if self._early_targets is None:
             self._print(
                 "Getting optimized test execution order from Launchable...\n")
 
             self._subset(test)
+        else:
+            # Only target files were loaded, and files found without tests. Order them, and keep tests that failed
+            # to load so they are reported.
+            subset(test, self._early_targets + self._early_kept + [FAILURE_NAME])
+
+        self._print("Test execution optimized by Launchable ")
+        # A rocket emoji
+        self._print("\U0001f680\n")
 
-            self._print("Test execution optimized by Launchable ")
-            # A rocket emoji
-            self._print("\U0001f680\n")
-            return test
+    def _splitTest(self, test):
+        index = build_index(test)
+        subset(test, self._localBin(index.names), index)
 
+    @profiler.hook
     @protect
     def startContext(self, context):
         self._startCapture()
 
+    @profiler.hook
     @protect
     def stopContext(self, context):
         self._endCapture()
 
+    @profiler.hook
     @protect
     def beforeTest(self, test):
         """Initializes a timer before starting a test."""
         self._timer = time()
         self._startCapture()
 
+    @profiler.hook
     @protect
     def afterTest(self, test):
         self._endCapture()
         self._currentStdout = None
         self._currentStderr = None
 
+    @profiler.hook
     @protect
     def addError(self, test, err, capt=None):
         type, value, traceback = err
@@ -137,44 +281,165 @@ class Launchable(Plugin):
         # and we don't support unittest2 (python2) from now.
         if type in (unittest.case.SkipTest, SkipTest):
             self._addResult(test, CaseEvent.TEST_SKIPPED,
-                            self._uploader.enqueue_failure)
+                            self._uploader.enqueue_failure, capt)
         elif type not in (ImportError, ValueError):
             self._addResult(test, CaseEvent.TEST_FAILED,
-                            self._uploader.enqueue_failure)
+                            self._uploader.enqueue_failure, capt)
 
+    @profiler.hook
     @protect
     def addFailure(self, test, err, capt=None, tb_info=None):
         self._addResult(test, CaseEvent.TEST_FAILED,
-                        self._uploader.enqueue_failure)
+                        self._uploader.enqueue_failure, capt)
 
+    @profiler.hook
     @protect
     def addSuccess(self, test, capt=None):
-        self._addResult(test, CaseEvent.TEST_PASSED, self._uploader.enqueue_success)
+        self._addResult(test, CaseEvent.TEST_PASSED, self._uploader.enqueue_success, capt)
 
     @protect
     def finalize(self, test):
         while self._capture_stack:
             self._endCapture()
 
-        self._uploader.join()
-        self._client.finish()
+        # A run whose upload fails is the one its timings are wanted for, so they are reported either way
+        try:
+            # Written locally, so it does not depend on the upload succeeding
+            if self._history is not None:
+                with metrics.timer("history.join_seconds"):
+                    self._history.join()
+
+            # In case the test runner did not call prepareTest
+            self._startUploader()
+
+            with metrics.timer("uploader.join_seconds"):
+                self._uploader.join()
+            with metrics.timer("client.finish_seconds"):
+                self._client.finish()
 
-        self._print("Test results have been successfully uploaded to Launchable\n")
+            self._print("Test results have been successfully uploaded to Launchable\n")
+        finally:
+            if profiler.enabled:
+                self._reportHookOverhead()
+
+            metrics.dump(os.getenv(METRICS_FILE_KEY))
+
+    # Uploading needs the session, so the uploader starts once the background thread has started it
+    def _startUploader(self):
+        if self._uploaderStarted:
+            return
+        self._uploaderStarted = True
+
+        with metrics.timer("plugin.session_wait_seconds"):
+            self._prefetch.wait_session()
+        self._uploader.start()
 
     def _subset(self, test):
-        test_names = get_test_names(test)
+        # Names go to the subset command as they are found, so it starts up while the tree is still being loaded
+        with metrics.timer("plugin.get_test_names_seconds"):
+            try:
+                index = build_index(test, self._prefetch.add)
+            finally:
+                self._prefetch.close()
+        metrics.increment("plugin.subset_candidates", len(index.names))
+
+        with metrics.timer("plugin.subset_wait_seconds"):
+            targets = self._prefetch.result()
+        targets = self._localBin(targets)
+
+        # Keep the order of targets, which puts the tests most likely to fail first
+        subset(test, targets, index)
+
+    # Find test files from their paths before nose imports any of them and send their names to the subset command.
+    # If it fails, tests are loaded as usual and their names are sent in prepareTest instead.
+    @protect
+    def _subsetEarly(self):
+        with metrics.timer("plugin.discover_seconds"):
+            files = discover_test_files(self.conf)
+            if files is None:
+                logger.warning("Could not find test files before loading them. Subsetting after loading instead")
+                return
+
+            cache = DiscoveryCache.load(self.conf.testMatch, self.conf.workingDir)
+            tests = scan_test_files(files, self.conf.testMatch, cache=cache)
+            cache.save()
+
+        # Names are relative to the working directory, where nose runs the tests. Like get_test_names,
+        # files without tests are left out.
+        names = {os.path.relpath(path, self.conf.workingDir): path for path in files if tests[path] != []}
+        metrics.increment("plugin.subset_candidates", len(names))
+
+        # Files found without tests, or that cannot be parsed, are still loaded as nose would load them.
+        # Tests the scan could not see are then kept, and errors are reported.
+        loaded = [path for path in files if not tests[path]]
+
+        self._print("Getting optimized test execution order from Launchable...\n")
+        for name in names:
+            self._prefetch.add(name)
+        self._prefetch.close()
+
+        self._early_names = names
+        self._early_kept = [os.path.relpath(path, self.conf.workingDir) for path in loaded if tests[path] == []]
+        self._candidate_files = set(files) - set(loaded)
+        self._candidate_dirs = _parents(self._candidate_files, self.conf.workingDir)
+        self._loaded_files = set(loaded)
+
+    # Wait for the subset taken from discovered files. It is needed once nose starts loading tests.
+    def _joinEarlySubset(self):
+        if self._early_names is None or self._early_targets is not None:
+            return
 
-        targets = self._client.subset(test_names, self.subset_options, self.subset_target)
+        try:
+            with metrics.timer("plugin.subset_wait_seconds"):
+                targets = self._prefetch.result()
+        except Exception as e:
+            # Load every file. prepareTest then fails the same way and the tests run in standard order.
+            self._early_names = None
+            self._candidate_files = set()
+            self._candidate_dirs = set()
+            handleError(e)
+            return
 
-        subset(test, set(targets))
+        targets = self._localBin(targets)
+        self._early_kept = self._localBin(self._early_kept)
+        names = self._early_names
+        self._target_files = {names[name] for name in targets if name in names}
+        self._target_dirs = _parents(self._target_files | self._loaded_files, self.conf.workingDir)
+        self._early_targets = targets
+
+    # The names of this shard's bin with --launchable-local-split, in the order given. Every shard splits the same
+    # names with the same history the same way, so the bins cover all names without the shards talking to each other.
+    def _localBin(self, names):
+        if self.local_split is None:
+            return names
+
+        index, count = self.local_split
+        with metrics.timer("plugin.local_split_seconds"):
+            bins = split(names, load_file_durations(os.getenv(HISTORY_FILE_KEY)), count)
+        logger.debug("Local split bin {}/{}: {}".format(index, count, bins[index - 1]))
+
+        return bins[index - 1]
+
+    def _findNoseCapture(self):
+        plugins = getattr(getattr(self, "conf", None), "plugins", None)
+        for plugin in getattr(plugins, "plugins", []):
+            if isinstance(plugin, Capture) and plugin.enabled:
+                return plugin
+        return None
 
     def _startCapture(self):
         self._capture_stack.append((sys.stdout, sys.stderr))
-        self._currentStdout = StringIO()
-        self._currentStderr = StringIO()
-        sys.stdout = Tee(self.encoding, self._currentStdout, sys.stdout)
+        self._currentStderr = self._buffers.create()
         sys.stderr = Tee(self.encoding, self._currentStderr, sys.stderr)
 
+        # nose already holds stdout, so do not buffer it a second time
+        if self._stdoutFromNose:
+            self._currentStdout = None
+            return
+
+        self._currentStdout = self._buffers.create()
+        sys.stdout = Tee(self.encoding, self._currentStdout, sys.stdout)
+
     def _endCapture(self):
         if self._capture_stack:
             sys.stdout, sys.stderr = self._capture_stack.pop()
@@ -193,7 +458,29 @@ class Launchable(Plugin):
                 return value
         return ''
 
-    def _addResult(self, test, status, queueing):
+    def _getNoseStdout(self, test, capt):
+        # Passed by old nose versions
+        if capt is not None:
+            return capt
+
+        # Set by the Capture plugin when it formats an error or a failure
+        output = getattr(test, "capturedOutput", None)
+        if output is None and self._noseCapture is not None:
+            # A passing test: Capture still holds the buffer until its afterTest
+            output = self._noseCapture.buffer
+
+        return output or ''
+
+    def _getCapturedOutput(self, test, status, capt=None):
+        if self.capture_policy == CAPTURE_FAILURES and status != CaseEvent.TEST_FAILED:
+            return '', ''
+
+        if self._stdoutFromNose:
+            return self._getNoseStdout(test, capt), self._getCapturedStderr()
+
+        return self._getCapturedStdout(), self._getCapturedStderr()
+
+    def _addResult(self, test, status, queueing, capt=None):
         if not hasattr(test, "test"):
             logger.warn("This test case is skipped to report because this test doesn't have test attribute. (test id: {})".format(getattr(test, "id", None)))
             return
@@ -201,10 +488,23 @@ class Launchable(Plugin):
         test_path = get_test_path(test)
 
         logger.debug("Adding a test result: test: {}, context: {}, test_path: {}".format(test, test.context, test_path))
-        result = CaseEvent(test_path, self._timeTaken(), status, self._getCapturedStdout(),
-                           self._getCapturedStderr())
+        stdout, stderr = self._getCapturedOutput(test, status, capt)
+        result = CaseEvent(test_path, self._timeTaken(), status, stdout, stderr)
         queueing(result)
 
+        if self._history is not None:
+            self._history.record(result)
+
+    def _reportHookOverhead(self):
+        wall_time = time() - self._started
+
+        for name, values in profiler.samples.items():
+            for value in values:
+                metrics.observe("hook.{}_seconds".format(name), value)
+        metrics.increment("hook.total_seconds", profiler.total())
+
+        self._print(profiler.format_report(wall_time))
+
     # Bypass Capture plugin
     def _print(self, message):
         sys.__stdout__.write(message)
@@ -217,3 +517,18 @@ class Launchable(Plugin):
         # or success/failure added before test started probably
         # due to custom TestResult munging
         return 0.0
+
+
+# Directories between root and the given files
+def _parents(files, root):
+    # With a trailing separator, so that only directories below root match
+    root = os.path.join(os.path.abspath(root), "")
+
+    parents = set()
+    for path in files:
+        parent = os.path.dirname(path)
+        while parent not in parents and parent.startswith(root):
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+
+    return parents
@@ -0,0 +1,70 @@
+import queue
+import threading
+
+# Put in the name queue after the last name
+_END = object()
+
+
+# Starts the test session and then takes the subset on a background thread, so the API and CLI latency overlaps
+# test collection instead of adding to it. Names are either known up front or fed with add() while tests are
+# collected. The main thread waits only when it needs the session, to start uploading, or the targets,
+# to prune the suite.
+class SubsetPrefetch:
+    def __init__(self, client, options=None, target=None, subset=True, names=None):
+        self.client = client
+        self.options = options
+        self.target = target
+        self.subset = subset
+
+        self._names = names
+        self._queue = queue.Queue()
+        self._closed = names is not None
+        self._session = threading.Event()
+        self._targets = None
+        # Starting the session and taking the subset fail separately, so that results are uploaded without a subset
+        self._session_error = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name="launchable-prefetch")
+
+    def start(self):
+        self._thread.start()
+
+    def add(self, name):
+        self._queue.put(name)
+
+    # No more names will be added
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_END)
+
+    # Blocks until the test session is started, and raises what starting it raised
+    def wait_session(self):
+        self._session.wait()
+        if self._session_error is not None:
+            raise self._session_error
+
+    # Blocks until the subset is taken and returns the targets, or raises what the background thread raised
+    def result(self):
+        self.close()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        return self._targets
+
+    def _run(self):
+        try:
+            try:
+                self.client.start()
+            except Exception as e:
+                self._session_error = e
+                raise
+            finally:
+                self._session.set()
+
+            if self.subset:
+                names = self._names if self._names is not None else iter(self._queue.get, _END)
+                self._targets = self.client.subset(names, self.options, self.target)
+        except Exception as e:
+            self._error = e
@@ -0,0 +1,70 @@
+import os
+from functools import wraps
+from time import perf_counter
+
+PROFILE_HOOKS_KEY = "LAUNCHABLE_PROFILE_HOOKS"
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1)
+
+
+# Records the time spent inside each plugin hook when LAUNCHABLE_PROFILE_HOOKS is set.
+# Hooks run on the main thread only, so samples are appended without a lock.
+class HookProfiler:
+    def __init__(self):
+        self.enabled = bool(os.getenv(PROFILE_HOOKS_KEY))
+        self.samples = {}
+
+    def reset(self):
+        self.enabled = bool(os.getenv(PROFILE_HOOKS_KEY))
+        self.samples = {}
+
+    def hook(self, f):
+        name = f.__name__
+
+        @wraps(f)
+        def func(*args, **kwargs):
+            if not self.enabled:
+                return f(*args, **kwargs)
+
+            started = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(perf_counter() - started)
+
+        return func
+
+    def total(self):
+        return sum(sum(values) for values in self.samples.values())
+
+    def histogram(self, name):
+        counts = [0] * (len(BUCKETS) + 1)
+        for value in self.samples.get(name, []):
+            i = 0
+            while i < len(BUCKETS) and value > BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+
+        return counts
+
+    # A text report of every hook and the overhead as a share of the suite wall time
+    def format_report(self, wall_time):
+        labels = ["<={}s".format(b) for b in BUCKETS] + [">{}s".format(BUCKETS[-1])]
+
+        lines = ["Launchable plugin hook overhead:"]
+        for name in sorted(self.samples):
+            values = self.samples[name]
+            lines.append("  {}: calls: {}, total: {:.6f}s, mean: {:.6f}s, max: {:.6f}s".format(
+                name, len(values), sum(values), sum(values) / len(values), max(values)))
+            lines.append("    " + ", ".join(
+                "{}: {}".format(label, count) for label, count in zip(labels, self.histogram(name))))
+
+        total = self.total()
+        share = total / wall_time * 100 if wall_time > 0 else 0.0
+        lines.append("  total: {:.6f}s ({:.2f}% of {:.3f}s suite wall time)".format(total, share, wall_time))
+
+        return "\n".join(lines) + "\n"
+
+
+profiler = HookProfiler()
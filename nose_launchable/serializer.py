@@ -0,0 +1,84 @@
+import json
+
+from nose_launchable.capture import SpilledOutput
+from nose_launchable.case_event import CaseEvent
+
+# orjson is an optional fast backend. It returns bytes directly, so no intermediate str is created.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. lone surrogates in captured output which orjson refuses to encode
+            pass
+
+    return _stdlib_dumps(obj)
+
+
+# Bytes serialize_events adds around the events, i.e. {"events":[]}
+BATCH_OVERHEAD = len(b'{"events":[]}')
+
+
+# Encode a CaseEvent into JSON bytes. The testPath is encoded once and written to both testPath and data.testPath.
+# The result is cached on the event, so sizing an event for batching and uploading it encode it only once.
+def encode_event(event):
+    if not isinstance(event, CaseEvent):
+        return _dumps(event.to_body())
+
+    if event.encoded is None:
+        event.encoded = _encode_case_event(event)
+
+    return event.encoded
+
+
+# Captured output moved to a temp file is escaped chunk by chunk straight from the file
+def _dumps_output(output):
+    if not isinstance(output, SpilledOutput):
+        return _dumps(output)
+
+    parts = [b'"']
+    for text in output.chunks():
+        # stdlib json escapes to ASCII, and the quotes it adds are dropped
+        parts.append(json.dumps(text)[1:-1].encode("ascii"))
+    parts.append(b'"')
+
+    return b"".join(parts)
+
+
+def _encode_case_event(event):
+    test_path = _dumps([t.to_body() for t in event.test_path])
+
+    return b"".join([
+        b'{"type":', _dumps(event.EVENT_TYPE),
+        b',"testPath":', test_path,
+        b',"duration":', _dumps(event.duration),
+        b',"status":', _dumps(event.status),
+        b',"stdout":', _dumps_output(event.stdout),
+        b',"stderr":', _dumps_output(event.stderr),
+        b',"data":{"testPath":', test_path, b'}',
+        b',"created_at":', _dumps(event.created_at),
+        b'}',
+    ])
+
+
+# Serialize events into a request body of {"events": [...]}.
+# Each event is encoded straight to bytes and joined once, so the batch never exists as a dict tree or a str.
+def serialize_events(events):
+    parts = [b'{"events":[']
+    for i, event in enumerate(events):
+        if i != 0:
+            parts.append(b",")
+        parts.append(encode_event(event))
+    parts.append(b"]}")
+
+    return b"".join(parts)
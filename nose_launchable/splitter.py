@@ -0,0 +1,38 @@
+import heapq
+
+# Duration of a test file without history when no file has any
+DEFAULT_DURATION = 1.0
+
+
+# Parse a bin like "2/5" into (2, 5)
+def parse_bin(value):
+    index, count = (int(v) for v in value.split("/"))
+    if not 1 <= index <= count:
+        raise ValueError("A bin must be <index>/<count> with 1 <= index <= count: {}".format(value))
+
+    return index, count
+
+
+# Split names into count bins of about the same total duration with the longest processing time first rule:
+# names are taken from the longest and each goes to the bin with the least total so far.
+# Names without a duration count as the mean of the known ones. Ties are broken by name and by bin index,
+# so every shard given the same names and durations computes the same bins without talking to the others.
+# Names keep their input order within a bin.
+def split(names, durations, count):
+    unique = list(dict.fromkeys(names))
+
+    known = [durations[name] for name in unique if name in durations]
+    default = sum(known) / len(known) if known else DEFAULT_DURATION
+
+    loads = [(0.0, i) for i in range(count)]
+    assigned = {}
+    for name in sorted(unique, key=lambda n: (-durations.get(n, default), n)):
+        load, i = heapq.heappop(loads)
+        assigned[name] = i
+        heapq.heappush(loads, (load + durations.get(name, default), i))
+
+    bins = [[] for _ in range(count)]
+    for name in unique:
+        bins[assigned[name]].append(name)
+
+    return bins
@@ -0,0 +1,291 @@
+import collections
+import json
+import os
+import shutil
+import struct
+import sys
+import threading
+import uuid
+from time import time
+
+from nose_launchable.log import logger
+
+# fcntl is not available on Windows. There, abandoned spools are only resent through the flush command.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCKING_SUPPORTED = fcntl is not None
+
+SPOOL_DIR_KEY = "LAUNCHABLE_SPOOL_DIR"
+
+DEFAULT_MAX_SEGMENT_BYTES = 16 * 1024 * 1024
+
+_SEGMENT_PREFIX = "segment-"
+_ACK_FILE = "ack"
+_SESSION_FILE = "session"
+_LOCK_FILE = "lock"
+
+# A spool still under its hidden name after this many seconds was left by a process that died while creating it
+_STALE_TMP_SECONDS = 3600
+
+# Every record is a serialized event batch prefixed with its length
+_HEADER = struct.Struct(">I")
+
+
+class _Record:
+    def __init__(self, segment, end):
+        self.segment = segment
+        self.end = end
+        self.acked = False
+
+
+# An append-only on-disk log of serialized event batches owned by one uploader.
+#
+# Layout: <root>/<spool id>/{session, lock, ack, segment-N}
+# A batch is appended before it is uploaded and acknowledged after the upload succeeds.
+# The ack file holds the position up to which every batch is delivered, so whatever comes after it
+# is left over when the process dies and is resent by resend() on the next run or by the flush command.
+class Spool:
+    def __init__(self, directory, session, lock, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES):
+        self.directory = directory
+        self.session = session
+        self.max_segment_bytes = max_segment_bytes
+
+        self._lock = lock
+        self._mutex = threading.Lock()
+        self._pending = collections.deque()
+        self._segment = 0
+        self._file = None
+        self._closed = False
+
+    @classmethod
+    def create(cls, root, session, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES):
+        name = uuid.uuid4().hex
+        # Prepare the spool under a hidden name so resend() never sees it half-initialized
+        tmp = os.path.join(root, "." + name)
+        os.makedirs(tmp)
+
+        lock = _try_lock(tmp)
+        _write_atomically(os.path.join(tmp, _SESSION_FILE), session)
+
+        directory = os.path.join(root, name)
+        os.rename(tmp, directory)
+
+        return cls(directory, session, lock, max_segment_bytes)
+
+    # Appends one batch. Called once per batch from the uploader workers, never per test.
+    # Returns None once the spool is closed.
+    def append(self, payload):
+        with self._mutex:
+            if self._closed:
+                return None
+
+            if self._file is None or self._file.tell() >= self.max_segment_bytes:
+                self._rotate()
+
+            self._file.write(_HEADER.pack(len(payload)))
+            self._file.write(payload)
+            # flush() hands the batch to the OS so it survives the process being killed
+            self._file.flush()
+
+            record = _Record(self._segment, self._file.tell())
+            self._pending.append(record)
+            return record
+
+    def ack(self, record):
+        with self._mutex:
+            if self._closed or record is None:
+                return
+
+            record.acked = True
+
+            # Batches can be acknowledged out of order, so commit only the fully delivered prefix
+            committed = None
+            while self._pending and self._pending[0].acked:
+                committed = self._pending.popleft()
+
+            if committed is None:
+                return
+
+            _write_atomically(os.path.join(self.directory, _ACK_FILE),
+                              json.dumps({"segment": committed.segment, "offset": committed.end}))
+
+            for segment in _segments(self.directory):
+                if segment < committed.segment:
+                    os.remove(_segment_path(self.directory, segment))
+
+    def close(self):
+        with self._mutex:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            if not self._pending:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            else:
+                logger.warning("{} test result batches were not uploaded and are kept in {}".format(
+                    len(self._pending), self.directory))
+
+            _unlock(self._lock)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+
+        self._segment += 1
+        self._file = open(_segment_path(self.directory, self._segment), "ab")
+
+
+# Upload batches left in spools of dead processes under root, then delete the spools.
+# upload is called as upload(payload, session) and is usually LaunchableClient.upload_payload.
+def resend(root, upload):
+    if not os.path.isdir(root):
+        return 0
+
+    sent = 0
+    for name in sorted(os.listdir(root)):
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory):
+            continue
+        if name.startswith("."):
+            _remove_stale_tmp(directory)
+            continue
+
+        lock = _try_lock(directory)
+        if lock is None:
+            # Owned by a running process
+            continue
+
+        try:
+            session_path = os.path.join(directory, _SESSION_FILE)
+            if os.path.exists(session_path):
+                with open(session_path) as f:
+                    session = f.read()
+
+                for segment, offset, payload in _read_records(directory):
+                    upload(payload, session)
+                    _write_atomically(os.path.join(directory, _ACK_FILE),
+                                      json.dumps({"segment": segment, "offset": offset}))
+                    sent += 1
+
+            logger.debug("Resent spooled test results: directory: {}".format(directory))
+            shutil.rmtree(directory, ignore_errors=True)
+        finally:
+            _unlock(lock)
+
+    return sent
+
+
+# A spool that is still being created is only briefly under its hidden name
+def _remove_stale_tmp(directory):
+    try:
+        age = time() - os.path.getmtime(directory)
+    except OSError:
+        return
+
+    if age > _STALE_TMP_SECONDS:
+        logger.debug("Removing a spool left half-created: directory: {}".format(directory))
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _read_records(directory):
+    ack_segment, ack_offset = 0, 0
+
+    ack_path = os.path.join(directory, _ACK_FILE)
+    if os.path.exists(ack_path):
+        with open(ack_path) as f:
+            ack = json.load(f)
+        ack_segment, ack_offset = ack["segment"], ack["offset"]
+
+    for segment in _segments(directory):
+        if segment < ack_segment:
+            continue
+
+        with open(_segment_path(directory, segment), "rb") as f:
+            if segment == ack_segment:
+                f.seek(ack_offset)
+
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+
+                size, = _HEADER.unpack(header)
+                payload = f.read(size)
+                # A torn write at the tail of the last segment
+                if len(payload) < size:
+                    break
+
+                yield segment, f.tell(), payload
+
+
+def _segments(directory):
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(_SEGMENT_PREFIX):
+            segments.append(int(name[len(_SEGMENT_PREFIX):]))
+
+    return sorted(segments)
+
+
+def _segment_path(directory, segment):
+    return os.path.join(directory, "{}{:06d}".format(_SEGMENT_PREFIX, segment))
+
+
+def _write_atomically(path, content):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _try_lock(directory):
+    f = open(os.path.join(directory, _LOCK_FILE), "a")
+    if fcntl is None:
+        return f
+
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+
+    return f
+
+
+def _unlock(lock):
+    if lock is None:
+        return
+
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+
+# Entry point of the nose-launchable-flush command
+def main(argv=None):
+    from nose_launchable.client import LaunchableClientFactory
+
+    argv = sys.argv[1:] if argv is None else argv
+    root = argv[0] if argv else os.getenv(SPOOL_DIR_KEY)
+    if not root:
+        sys.stderr.write("Usage: nose-launchable-flush [spool directory] (or set {})\n".format(SPOOL_DIR_KEY))
+        return 1
+
+    clients = {}
+
+    def upload(payload, session):
+        if session not in clients:
+            clients[session] = LaunchableClientFactory.prepare(None, session)
+        clients[session].upload_payload(payload, session)
+
+    sent = resend(root, upload)
+    sys.stdout.write("Uploaded {} spooled test result batches\n".format(sent))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
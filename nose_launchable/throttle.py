@@ -0,0 +1,97 @@
+import email.utils
+import threading
+from time import monotonic, time
+
+from requests.exceptions import ConnectionError, Timeout
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+DEFAULT_BACKOFF_FACTOR = 2
+DEFAULT_FAST_LATENCY = 1.0
+# A Retry-After value is honoured up to this many seconds, so one response cannot stall every upload for long
+DEFAULT_MAX_BACKOFF = 60
+
+
+# Adjusts the upload batch size and the number of uploads in flight from server feedback (AIMD).
+# Every fast response adds a step to both, and every throttled or failed response halves them.
+# A Retry-After value pauses all uploads until it passes.
+class AdaptiveThrottle:
+    def __init__(self, max_batch_size, max_concurrency, fast_latency=DEFAULT_FAST_LATENCY):
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.fast_latency = fast_latency
+
+        self.batch_size = max_batch_size
+        self.concurrency = max_concurrency
+
+        self._batch_size_step = max(1, max_batch_size // 10)
+        self._in_flight = 0
+        self._not_before = 0
+        self._cond = threading.Condition()
+
+    # Blocks until an upload slot is free under the current concurrency
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    # Seconds to wait before sending the next request
+    def pause(self):
+        with self._cond:
+            return max(0, self._not_before - monotonic())
+
+    def on_success(self, latency):
+        if latency > self.fast_latency:
+            return
+
+        with self._cond:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self._batch_size_step)
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self._cond.notify_all()
+
+    def on_throttled(self, delay):
+        with self._cond:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+            self._not_before = max(self._not_before, monotonic() + delay)
+
+
+# Seconds to wait before retrying a failed upload, at most max_backoff, or None if the error is not worth retrying
+def retry_delay(e, attempt, backoff_factor=DEFAULT_BACKOFF_FACTOR, max_backoff=DEFAULT_MAX_BACKOFF):
+    response = getattr(e, "response", None)
+
+    if response is not None:
+        if response.status_code not in RETRYABLE_STATUS:
+            return None
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return min(retry_after, max_backoff)
+    elif not isinstance(e, (ConnectionError, Timeout)):
+        return None
+
+    return min(backoff_factor * (2 ** attempt), max_backoff)
+
+
+# Retry-After is either seconds or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, date.timestamp() - time())
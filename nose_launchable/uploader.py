@@ -1,21 +1,37 @@
 import os
 import queue
 import threading
-from time import sleep
+from time import monotonic, sleep
 
+from nose_launchable import spool
+from nose_launchable.capture import SpilledOutput
+from nose_launchable.log import logger
+from nose_launchable.metrics import metrics
 from nose_launchable.protecter import protect
+from nose_launchable.serializer import BATCH_OVERHEAD, encode_event, serialize_events
+from nose_launchable.throttle import AdaptiveThrottle, DEFAULT_MAX_BACKOFF, retry_delay
 
 
 class UploaderFactory:
     SUCCESS_REPORT_INTERVAL_KEY = "LAUNCHABLE_SUCCESS_REPORT_INTERVAL"
     FAILURE_REPORT_INTERVAL_KEY = "LAUNCHABLE_FAILURE_REPORT_INTERVAL"
+    CONCURRENCY_KEY = "LAUNCHABLE_UPLOAD_CONCURRENCY"
+    MAX_BATCH_SIZE_KEY = "LAUNCHABLE_MAX_BATCH_SIZE"
+    MAX_BATCH_BYTES_KEY = "LAUNCHABLE_MAX_BATCH_BYTES"
+    TIMEOUT_KEY = "LAUNCHABLE_UPLOAD_TIMEOUT"
 
     DEFAULT_SUCCESS_REPORT_INTERVAL = 3
     DEFAULT_FAILURE_REPORT_INTERVAL = 2
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_MAX_BATCH_BYTES = 4 * 1024 * 1024
+    DEFAULT_TIMEOUT = 300
 
     @classmethod
     def prepare(cls, client):
-        return Uploader(client, cls._get_success_interval(), cls._get_failure_interval())
+        return Uploader(client, cls._get_success_interval(), cls._get_failure_interval(),
+                        max_batch_size=cls._get_max_batch_size(), max_batch_bytes=cls._get_max_batch_bytes(),
+                        spool_dir=cls._get_spool_dir(), concurrency=cls._get_concurrency(),
+                        timeout=cls._get_timeout())
 
     @classmethod
     def _get_success_interval(cls):
@@ -25,23 +41,84 @@ class UploaderFactory:
     def _get_failure_interval(cls):
         return os.getenv(cls.FAILURE_REPORT_INTERVAL_KEY) or cls.DEFAULT_FAILURE_REPORT_INTERVAL
 
+    @classmethod
+    def _get_spool_dir(cls):
+        return os.getenv(spool.SPOOL_DIR_KEY)
+
+    @classmethod
+    def _get_max_batch_size(cls):
+        return int(os.getenv(cls.MAX_BATCH_SIZE_KEY) or DEFAULT_MAX_BATCH_SIZE)
+
+    @classmethod
+    def _get_max_batch_bytes(cls):
+        return int(os.getenv(cls.MAX_BATCH_BYTES_KEY) or cls.DEFAULT_MAX_BATCH_BYTES)
+
+    @classmethod
+    def _get_concurrency(cls):
+        return int(os.getenv(cls.CONCURRENCY_KEY) or cls.DEFAULT_CONCURRENCY)
+
+    @classmethod
+    def _get_timeout(cls):
+        return float(os.getenv(cls.TIMEOUT_KEY) or cls.DEFAULT_TIMEOUT)
+
 
 DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_RETRIES = 5
+
+TRUNCATED_MARKER = "\n... (truncated by nose-launchable to fit the upload size limit)"
+
 
 class Uploader:
 
-    def __init__(self, client, success_interval, failure_interval, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+    def __init__(self, client, success_interval, failure_interval, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 spool_dir=None, concurrency=1, max_batch_bytes=None, timeout=None, max_retries=DEFAULT_MAX_RETRIES,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
         self.client = client
 
         self.success_queue = queue.Queue()
         self.failure_queue = queue.Queue()
 
-        self.success_worker = threading.Thread(target=self._worker, args=(self.success_queue, success_interval,))
-        self.failure_worker = threading.Thread(target=self._worker, args=(self.failure_queue, failure_interval,))
+        # Threads are daemons so that giving up on uploads after the timeout does not keep the process alive
+        self.success_worker = threading.Thread(target=self._worker, args=(self.success_queue, success_interval, "success"),
+                                               daemon=True)
+        self.failure_worker = threading.Thread(target=self._worker, args=(self.failure_queue, failure_interval, "failure"),
+                                               daemon=True)
 
         self.max_batch_size = max_batch_size
+        # Limit of a serialized batch in bytes. None means batches are limited only by the number of events.
+        self.max_batch_bytes = max_batch_bytes
+
+        # Both workers hand batches to shared sender threads so a slow request does not hold back the batches behind it.
+        # The throttle bounds batches in flight, which makes the workers stop draining while the senders are busy,
+        # and shrinks or grows the batch size and the concurrency depending on how the API responds.
+        self.concurrency = concurrency
+        self.throttle = AdaptiveThrottle(max_batch_size, concurrency)
+        self._tasks = queue.Queue()
+        self._senders = [threading.Thread(target=self._sender, daemon=True) for _ in range(concurrency)]
+
+        # Seconds join() may wait for the uploads. None waits until everything is sent.
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self._deadline = None
+
+        # Batches are written to the spool before uploading so they survive a killed process or an API outage
+        self.spool_dir = spool_dir
+        self.spool = None
+        self.resend_worker = threading.Thread(target=self._resend, daemon=True)
 
     def start(self):
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.spool = spool.Spool.create(self.spool_dir, self.client.test_session_context.get_session())
+
+            # Without file locks spools of other running processes cannot be told apart from abandoned ones
+            if spool.LOCKING_SUPPORTED:
+                self.resend_worker.start()
+
+        for sender in self._senders:
+            sender.start()
+
         self.success_worker.start()
         self.failure_worker.start()
 
@@ -56,35 +133,232 @@ class Uploader:
         # self.success_queue.join()
         # self.failure_queue.join()
 
+        if self.timeout is not None:
+            self._deadline = monotonic() + self.timeout
+
         self.success_queue.put(None)
         self.failure_queue.put(None)
 
-        self.success_worker.join()
-        self.failure_worker.join()
+        self.success_worker.join(self._remaining())
+        self.failure_worker.join(self._remaining())
+
+        for _ in self._senders:
+            self._tasks.put(None)
+        for sender in self._senders:
+            sender.join(self._remaining())
+
+        if self.resend_worker.is_alive():
+            self.resend_worker.join(self._remaining())
+
+        threads = [self.success_worker, self.failure_worker, self.resend_worker] + self._senders
+        if any(t.is_alive() for t in threads):
+            logger.warning("Gave up waiting for test result uploads after {} seconds".format(self.timeout))
+            # Senders still running may write to the spool, so it is left to be resent by the next run
+            return
+
+        if self.spool is not None:
+            self.spool.close()
 
     # Main thread cannot catch child thread's errors
     @protect
-    def _worker(self, q, interval):
+    def _worker(self, q, interval, name):
+        # A batch is sent as soon as it is full (by count or by bytes) or its oldest event is `interval` seconds old,
+        # and whatever is left is flushed right away once the None sentinel arrives
         wait = True
+        # An event that did not fit in the previous batch
+        carry = None
 
         while wait:
-            sleep(interval)
+            if carry is None:
+                item = q.get()
+                if item is None:
+                    break
+                q.task_done()
+            else:
+                item, carry = carry, None
 
-            size = min(q.qsize(), self.max_batch_size)
+            results = [item]
+            size = BATCH_OVERHEAD + self._size(item)
+            deadline = monotonic() + float(interval)
 
-            results = []
-            for _ in range(size):
-                item = q.get()
+            while len(results) < self.throttle.batch_size:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
 
                 if item is None:
                     wait = False
                     break
 
-                results.append(item)
                 q.task_done()
 
-            if len(results) != 0:
-                self._upload(results)
+                item_size = self._size(item)
+                if self.max_batch_bytes is not None and size + item_size > self.max_batch_bytes:
+                    carry = item
+                    break
+
+                results.append(item)
+                size += item_size
 
-    def _upload(self, events):
-        self.client.upload_events(events)
+            metrics.record("uploader.{}_queue_depth".format(name), q.qsize())
+            metrics.observe("uploader.batch_events", len(results))
+            self._submit(results)
+
+    # Serialized size of an event in a batch, including the separating comma
+    def _size(self, event):
+        if self.max_batch_bytes is None:
+            return 0
+
+        self._cut_spilled(event)
+        encoded = encode_event(event)
+        if BATCH_OVERHEAD + len(encoded) > self.max_batch_bytes:
+            encoded = self._truncate(event)
+
+        # The encoding is cached on the event, so its temp files are not read again
+        for output in (event.stdout, event.stderr):
+            if isinstance(output, SpilledOutput):
+                output.close()
+
+        return len(encoded) + 1
+
+    # Output spilled to a temp file that cannot fit in a batch is cut from the file before anything is encoded,
+    # so no more of it than a batch holds is ever read into memory
+    def _cut_spilled(self, event):
+        keep = self.max_batch_bytes - BATCH_OVERHEAD - len(TRUNCATED_MARKER)
+        for name in ("stdout", "stderr"):
+            output = getattr(event, name)
+            if isinstance(output, SpilledOutput) and len(output) > keep:
+                setattr(event, name, output.head(keep) + TRUNCATED_MARKER if keep > 0 else "")
+                output.close()
+
+    # Cut captured output of an event that cannot fit in a batch on its own
+    def _truncate(self, event):
+        encoded = encode_event(event)
+        budget = self.max_batch_bytes - BATCH_OVERHEAD
+
+        while len(encoded) > budget and (event.stdout or event.stderr):
+            name = "stdout" if len(event.stdout) >= len(event.stderr) else "stderr"
+            text = getattr(event, name)
+
+            # Every character takes at least one byte in JSON, so this removes at least the excess.
+            # The length of output spilled to a temp file is in bytes, which JSON never shrinks either.
+            keep = len(text) - (len(encoded) - budget) - len(TRUNCATED_MARKER)
+            if keep <= 0:
+                setattr(event, name, "")
+            elif isinstance(text, SpilledOutput):
+                setattr(event, name, text.head(keep) + TRUNCATED_MARKER)
+            else:
+                setattr(event, name, text[:keep] + TRUNCATED_MARKER)
+
+            event.encoded = None
+            encoded = encode_event(event)
+
+        if len(encoded) > budget:
+            logger.warning("A test result is larger than {} even without its output. It is sent in its own batch".format(
+                self.max_batch_bytes))
+
+        return encoded
+
+    def _submit(self, events):
+        self.throttle.acquire()
+        self._tasks.put(events)
+
+    def _sender(self):
+        while True:
+            events = self._tasks.get()
+            if events is None:
+                break
+
+            try:
+                self._send(events)
+            finally:
+                self.throttle.release()
+
+    # Runs on the sender threads, where errors cannot reach the main thread either
+    @protect
+    def _send(self, events):
+        if self.spool is None:
+            if self._expired():
+                logger.warning("Dropped {} test results that could not be uploaded in time".format(len(events)))
+                metrics.increment("uploader.dropped_events", len(events))
+                return
+
+            self._upload(self.client.upload_events, events)
+            return
+
+        payload = serialize_events(events)
+        record = self.spool.append(payload)
+        if self._expired():
+            # Resent by the next run
+            return
+
+        try:
+            self._upload(self.client.upload_payload, payload)
+        except Exception as e:
+            # The batch stays in the spool and is resent later, so keep the worker alive
+            logger.warning("Failed to upload test results. They are kept in {}: {}".format(self.spool.directory, e))
+            return
+
+        self.spool.ack(record)
+
+    # Upload a batch, retrying throttled or failed requests with backoff while there is time left
+    def _upload(self, upload, body):
+        attempt = 0
+
+        while True:
+            self._sleep(self.throttle.pause())
+
+            started = monotonic()
+            try:
+                upload(body)
+            except Exception as e:
+                delay = retry_delay(e, attempt, max_backoff=self.max_backoff)
+                if delay is None or attempt >= self.max_retries or not self._has_time(delay):
+                    metrics.increment("uploader.failed_batches")
+                    raise
+
+                logger.debug("Retrying a test result upload in {} seconds: {}".format(delay, e))
+                metrics.increment("uploader.retries")
+                self.throttle.on_throttled(delay)
+                attempt += 1
+                continue
+
+            self.throttle.on_success(monotonic() - started)
+            metrics.record("uploader.batch_size_limit", self.throttle.batch_size)
+            metrics.record("uploader.concurrency_limit", self.throttle.concurrency)
+            return
+
+    def _remaining(self):
+        if self._deadline is None:
+            return None
+
+        return max(0, self._deadline - monotonic())
+
+    def _expired(self):
+        return self._deadline is not None and monotonic() >= self._deadline
+
+    # Before join() sets the deadline, a retry may still not wait longer than join() would
+    def _has_time(self, delay):
+        if self._deadline is None:
+            return self.timeout is None or delay < self.timeout
+
+        return monotonic() + delay < self._deadline
+
+    def _sleep(self, seconds):
+        remaining = self._remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+
+        if seconds > 0:
+            sleep(seconds)
+
+    @protect
+    def _resend(self):
+        sent = spool.resend(self.spool_dir, self.client.upload_payload)
+        if sent:
+            logger.info("Uploaded {} test result batches left by a previous run".format(sent))
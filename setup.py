@@ -23,6 +23,9 @@ setup(
     long_description=_read("README.rst"),
     packages=find_packages(),
     install_requires=_requirements('requirements.txt'),
+    extras_require={
+        'fast-json': ['orjson'],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
@@ -33,5 +36,9 @@ setup(
         'nose.plugins.0.10': [
             'nose_launchable = nose_launchable:Launchable'
         ],
+        'console_scripts': [
+            'nose-launchable-flush = nose_launchable.spool:main',
+            'nose-launchable-history = nose_launchable.history:main',
+        ],
     },
 )
@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from nose_launchable.cache import SubsetCache, fcntl, get_or_create
+
+
+class TestGetOrCreate(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "shared", "subset")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_create_once(self):
+        started = threading.Event()
+
+        def create():
+            started.set()
+            # Keep the lock while the others start waiting
+            time.sleep(0.2)
+            return "subset/1"
+
+        create = MagicMock(side_effect=create)
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(get_or_create(self.path, create, 10, interval=0.01)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(["subset/1"] * 4, got)
+        create.assert_called_once_with()
+
+    def test_failure_releases_lock(self):
+        with self.assertRaises(RuntimeError):
+            get_or_create(self.path, MagicMock(side_effect=RuntimeError("subset")), 10)
+
+        self.assertEqual("subset/2", get_or_create(self.path, lambda: "subset/2", 10))
+
+    def test_lock_file_left(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path + ".lock", "w").close()
+
+        # Left by a process that died, which no longer holds the lock on it
+        self.assertEqual("subset/3", get_or_create(self.path, lambda: "subset/3", 10, interval=0.01))
+
+    @unittest.skipIf(fcntl is None, "requires file locks")
+    def test_held_lock(self):
+        os.makedirs(os.path.dirname(self.path))
+        holder = open(self.path + ".lock", "a")
+        fcntl.flock(holder, fcntl.LOCK_EX)
+
+        def release():
+            time.sleep(0.1)
+            with open(self.path, "w") as f:
+                f.write("subset/4")
+            holder.close()
+
+        thread = threading.Thread(target=release)
+        thread.start()
+        create = MagicMock(return_value="subset/5")
+
+        # Waits for the holder's file
+        self.assertEqual("subset/4", get_or_create(self.path, create, 10, interval=0.01))
+        create.assert_not_called()
+        thread.join()
+
+    @unittest.skipIf(fcntl is None, "requires file locks")
+    def test_held_lock_timeout(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".lock", "a") as holder:
+            fcntl.flock(holder, fcntl.LOCK_EX)
+
+            self.assertEqual("subset/6", get_or_create(self.path, lambda: "subset/6", 0.05, interval=0.01))
+
+
+    @unittest.skipIf(fcntl is None, "requires file locks")
+    def test_held_lock_timeout_keeps_published(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".lock", "a") as holder:
+            fcntl.flock(holder, fcntl.LOCK_EX)
+
+            def create():
+                # The holder publishes while this process takes its own
+                with open(self.path, "w") as f:
+                    f.write("subset/7")
+                return "subset/8"
+
+            self.assertEqual("subset/7", get_or_create(self.path, create, 0.05, interval=0.01))
+
+        with open(self.path) as f:
+            self.assertEqual("subset/7", f.read())
+        self.assertEqual(["subset", "subset.lock"], sorted(os.listdir(os.path.dirname(self.path))))
+
+    def test_empty_value(self):
+        create = MagicMock(return_value="")
+
+        self.assertEqual("", get_or_create(self.path, create, 10))
+        self.assertEqual("", get_or_create(self.path, create, 10))
+        create.assert_called_once_with()
+
+
+class TestSubsetCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, ".launchable", "subset.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_get(self):
+        cache = SubsetCache(self.path, 60, 8)
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("a", ["tests/test1.py"])
+
+        self.assertEqual(["tests/test1.py"], SubsetCache(self.path, 60, 8).get("a"))
+
+    def test_ttl(self):
+        cache = SubsetCache(self.path, 60, 8)
+        with patch("nose_launchable.cache.time", return_value=1000):
+            cache.put("a", ["tests/test1.py"])
+
+        with patch("nose_launchable.cache.time", return_value=1061):
+            self.assertIsNone(cache.get("a"))
+
+    def test_lru(self):
+        cache = SubsetCache(self.path, 60, 2)
+        with patch("nose_launchable.cache.time", side_effect=[1, 2, 3, 4, 5, 6, 7]):
+            cache.put("a", ["a"])
+            cache.put("b", ["b"])
+            # a is used after b was stored, so b is the one dropped
+            cache.get("a")
+            cache.put("c", ["c"])
+
+            self.assertEqual(["a"], cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(["c"], cache.get("c"))
@@ -0,0 +1,92 @@
+import os
+import unittest
+from unittest import mock
+
+from nose_launchable.capture import BoundedBuffer, CaptureBufferFactory, SpillBuffer, SpilledOutput
+
+
+class TestCaptureBufferFactory(unittest.TestCase):
+    @mock.patch.dict(os.environ, {"LAUNCHABLE_CAPTURE_HEAD_SIZE": "10", "LAUNCHABLE_CAPTURE_TAIL_SIZE": "20"})
+    def test_prepare(self):
+        buffer = CaptureBufferFactory.prepare().create()
+
+        self.assertEqual(10, buffer.head_size)
+        self.assertEqual(20, buffer.tail_size)
+
+    @mock.patch.dict(os.environ, {"LAUNCHABLE_CAPTURE_SPILL_SIZE": "30"})
+    def test_prepare_with_spill_size(self):
+        buffer = CaptureBufferFactory.prepare().create()
+
+        self.assertIsInstance(buffer, SpillBuffer)
+        self.assertEqual(30, buffer.spill_size)
+
+
+class TestBoundedBuffer(unittest.TestCase):
+    def test_within_limit(self):
+        buffer = BoundedBuffer(5, 5)
+        buffer.write("abc")
+        buffer.write("defg")
+
+        self.assertEqual("abcdefg", buffer.getvalue())
+        self.assertEqual(0, buffer.dropped)
+
+    def test_keep_head_and_tail(self):
+        buffer = BoundedBuffer(3, 4)
+        buffer.write("abcde")
+        buffer.write("fghij")
+        buffer.writelines(["kl", "m"])
+
+        self.assertEqual(6, buffer.dropped)
+        self.assertEqual("abc\n... (6 characters truncated by nose-launchable) ...\njklm", buffer.getvalue())
+
+    def test_many_small_writes(self):
+        buffer = BoundedBuffer(2, 3)
+        for c in "0123456789" * 300:
+            buffer.write(c)
+
+        self.assertTrue(buffer.getvalue().startswith("01\n"))
+        self.assertTrue(buffer.getvalue().endswith("\n789"))
+        self.assertEqual(2995, buffer.dropped)
+
+    def test_empty(self):
+        buffer = BoundedBuffer(2, 3)
+        buffer.write("")
+
+        self.assertEqual("", buffer.getvalue())
+
+
+class TestSpillBuffer(unittest.TestCase):
+    def test_in_memory(self):
+        buffer = SpillBuffer(10)
+        buffer.write("abc")
+        buffer.writelines(["de", ""])
+
+        self.assertEqual("abcde", buffer.getvalue())
+
+    def test_spill(self):
+        buffer = SpillBuffer(10)
+        buffer.write("0123456789")
+        buffer.write("あいう\n")
+        buffer.write("\ud800 tail")
+
+        value = buffer.getvalue()
+
+        self.assertIsInstance(value, SpilledOutput)
+        self.assertEqual("0123456789あいう\n\ud800 tail", str(value))
+        self.assertEqual(len("0123456789あいう\n\ud800 tail".encode("utf-8", "surrogatepass")), len(value))
+        self.assertEqual("0123456789あ", value.head(13))
+        # い is cut in half
+        self.assertEqual("0123456789あ", value.head(15))
+        self.assertEqual("0123456789あい", value.head(16))
+        self.assertEqual("", value.head(0))
+        # Lone surrogates are kept like in the whole output, and one cut in half is dropped
+        self.assertEqual("0123456789あいう\n\ud800", value.head(23))
+        self.assertEqual("0123456789あいう\n", value.head(22))
+
+    def test_value_does_not_change_after_getvalue(self):
+        buffer = SpillBuffer(1)
+        buffer.write("abc")
+        value = buffer.getvalue()
+        buffer.write("def")
+
+        self.assertEqual("abc", str(value))
@@ -1,11 +1,16 @@
+import gzip
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 import unittest
 import pytest
 from unittest import mock
 from unittest.mock import MagicMock, call
 
+from nose_launchable.cache import SubsetCache
 from nose_launchable.case_event import CaseEvent
 from nose_launchable.client import LaunchableClientFactory, LaunchableClient, TestSessionContext
 from nose_launchable.version import __version__
@@ -57,6 +62,48 @@ class TestLaunchableClientFactory(unittest.TestCase):
         self.assertIsNotNone(client.http)
         self.assertEqual(subprocess, client.process)
 
+    @mock.patch.dict(os.environ, {
+        "LAUNCHABLE_TOKEN": 'v1:org_name/wp_name:token',
+        "LAUNCHABLE_UPLOAD_COMPRESSION": 'GZIP',
+        "LAUNCHABLE_UPLOAD_COMPRESSION_THRESHOLD": '100',
+    })
+    def test_prepare_with_compression(self):
+        client = LaunchableClientFactory.prepare("test", None)
+
+        self.assertEqual(LaunchableClient.GZIP, client.compression)
+        self.assertEqual(100, client.compression_threshold)
+
+    @mock.patch.dict(os.environ, {
+        "LAUNCHABLE_TOKEN": 'v1:org_name/wp_name:token',
+        "LAUNCHABLE_SUBSET_CACHE_TTL": '3600',
+    })
+    def test_prepare_with_subset_cache(self):
+        client = LaunchableClientFactory.prepare("test", None, "/work")
+
+        self.assertEqual("/work/.launchable/subset.json", client.subset_cache.path)
+        self.assertEqual(3600, client.subset_cache.ttl)
+        self.assertEqual(32, client.subset_cache.max_entries)
+
+    @mock.patch.dict(os.environ, {
+        "LAUNCHABLE_TOKEN": 'v1:org_name/wp_name:token',
+        "LAUNCHABLE_SHARED_SUBSET_DIR": '/shared',
+    })
+    def test_prepare_with_shared_subset_without_locks(self):
+        with mock.patch("nose_launchable.cache.fcntl", None), \
+                mock.patch("nose_launchable.client.logger") as logger:
+            client = LaunchableClientFactory.prepare("test", None)
+
+        self.assertEqual("/shared", client.shared_subset_dir)
+        logger.warning.assert_called_once()
+
+    @mock.patch.dict(os.environ, {
+        "LAUNCHABLE_TOKEN": 'v1:org_name/wp_name:token',
+        "LAUNCHABLE_UPLOAD_COMPRESSION": 'br',
+    })
+    def test_prepare_with_unsupported_compression(self):
+        with self.assertRaises(Exception):
+            LaunchableClientFactory.prepare("test", None)
+
 
 class TestLaunchableClient(unittest.TestCase):
     def test_start_without_test_session(self):
@@ -126,6 +173,58 @@ class TestLaunchableClient(unittest.TestCase):
             expected_command, input=expected_input, encoding='utf-8', stdout='PIPE', stderr='PIPE')
         self.assertEqual(['tests/test2.py', 'tests/test1.py'], got)
 
+    def test_subset_streaming(self):
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_subprocess.PIPE = "PIPE"
+        mock_proc = mock_subprocess.Popen.return_value
+        mock_proc.returncode = 0
+        mock_proc.stdout.read.return_value = "tests/test2.py\n"
+        mock_proc.stderr.read.return_value = ""
+
+        client = LaunchableClient(
+            "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), mock_subprocess,
+            TestSessionContext("test", 1))
+
+        got = client.subset(iter(["tests/test1.py", "tests/test2.py"]), None, "10")
+
+        expected_command = ['launchable', 'subset', '--session',
+                            'builds/test/test_sessions/1', '--target', '10%', 'file']
+        mock_subprocess.Popen.assert_called_once_with(
+            expected_command, stdin='PIPE', stdout='PIPE', stderr='PIPE', encoding='utf-8')
+        mock_proc.stdin.write.assert_has_calls([call("tests/test1.py"), call("\ntests/test2.py")])
+        mock_subprocess.run.assert_not_called()
+        self.assertEqual(['tests/test2.py'], got)
+
+    def test_subset_streaming_failure(self):
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_proc = mock_subprocess.Popen.return_value
+        # The command exits before reading its input
+        mock_proc.stdin.write.side_effect = BrokenPipeError()
+        mock_proc.returncode = 1
+        mock_proc.stdout.read.return_value = ""
+        mock_proc.stderr.read.return_value = "error"
+
+        client = LaunchableClient(
+            "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), mock_subprocess,
+            TestSessionContext("test", 1))
+
+        with self.assertRaises(RuntimeError):
+            client.subset(iter(["tests/test1.py"]), None, "10")
+
+    def test_subset_streaming_large_stderr(self):
+        # Writes more than a pipe holds to stderr before reading any input
+        script = "import sys; sys.stderr.write('x' * 200000); sys.stderr.flush(); print(len(sys.stdin.read()))"
+        client = LaunchableClient(
+            "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), subprocess,
+            TestSessionContext("test", 1))
+        names = ["tests/test_{}.py".format(i) for i in range(20000)]
+
+        proc = client._run_streaming([sys.executable, "-c", script], iter(names))
+
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual(str(len("\n".join(names))), proc.stdout.strip())
+        self.assertEqual(200000, len(proc.stderr))
+
     def test_subset_success_with_options(self):
         mock_output = MagicMock(name="output")
         mock_subprocess = MagicMock(name="subprecess")
@@ -200,6 +299,175 @@ class TestLaunchableClient(unittest.TestCase):
             ])
         self.assertEqual(['tests/test2.py'], got)
 
+    def _native_client(self, *responses):
+        mock_requests = MagicMock(name="requests")
+        mock_requests.post.side_effect = list(responses)
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_subprocess.PIPE = "PIPE"
+
+        client = LaunchableClient(
+            "base_url", "org_name", "wp_name", "token", mock_requests, mock_subprocess,
+            TestSessionContext("test", 1), native_subset=True)
+        return client, mock_requests, mock_subprocess
+
+    def _response(self, body):
+        res = MagicMock(name="response")
+        res.status_code = 200
+        res.json.return_value = body
+        return res
+
+    def test_subset_native(self):
+        client, mock_requests, mock_subprocess = self._native_client(self._response({
+            "testPaths": [[{"type": "file", "name": "tests/test2.py"}]],
+            "rest": [[{"type": "file", "name": "tests/test1.py"}]],
+            "subsettingId": 123,
+        }))
+
+        got = client.subset(iter(["tests/test1.py", "tests/test2.py"]), None, "10")
+
+        self.assertEqual(['tests/test2.py'], got)
+        mock_subprocess.run.assert_not_called()
+        mock_subprocess.Popen.assert_not_called()
+
+        args, kwargs = mock_requests.post.call_args
+        self.assertEqual("base_url/intake/organizations/org_name/workspaces/wp_name/subset", args[0])
+        self.assertEqual({
+            "testPaths": [[{"type": "file", "name": "tests/test1.py"}], [{"type": "file", "name": "tests/test2.py"}]],
+            "testRunner": "file",
+            "session": {"id": 1},
+            "goal": {"type": "subset-by-percentage", "percentage": 0.1},
+        }, json.loads(kwargs["data"]))
+
+    def test_subset_native_time(self):
+        client, mock_requests, _ = self._native_client(self._response({"testPaths": []}))
+
+        client.subset(["tests/test1.py"], "--time 600", None)
+
+        _, kwargs = mock_requests.post.call_args
+        self.assertEqual({"type": "subset-by-absolute-time", "duration": 600.0}, json.loads(kwargs["data"])["goal"])
+
+    def test_split_subset_native(self):
+        client, mock_requests, mock_subprocess = self._native_client(
+            self._response({"testPaths": [], "subsettingId": 123}),
+            self._response({"testPaths": [[{"type": "file", "name": "tests/test2.py"}]]}),
+        )
+
+        got = client.subset(["tests/test1.py", "tests/test2.py"], "--target 30% --bin 1/2", None)
+
+        self.assertEqual(['tests/test2.py'], got)
+        mock_subprocess.run.assert_not_called()
+
+        args, kwargs = mock_requests.post.call_args
+        self.assertEqual("base_url/intake/organizations/org_name/workspaces/wp_name/subset/123/slice", args[0])
+        self.assertEqual({"sliceCount": 2, "sliceIndex": 0}, json.loads(kwargs["data"]))
+
+    def test_subset_native_fallback(self):
+        error = MagicMock(name="response")
+        error.raise_for_status.side_effect = Exception("503 Server Error")
+        client, _, mock_subprocess = self._native_client(error)
+        mock_subprocess.run.return_value.returncode = 0
+        mock_subprocess.run.return_value.stdout = "tests/test2.py\n"
+
+        got = client.subset(iter(["tests/test1.py", "tests/test2.py"]), None, "10")
+
+        self.assertEqual(['tests/test2.py'], got)
+        mock_subprocess.run.assert_called_once_with(
+            ['launchable', 'subset', '--session', 'builds/test/test_sessions/1', '--target', '10%', 'file'],
+            input='tests/test1.py\ntests/test2.py', encoding='utf-8', stdout='PIPE', stderr='PIPE')
+
+    def test_subset_native_unsupported_options(self):
+        client, mock_requests, mock_subprocess = self._native_client()
+        mock_subprocess.run.return_value.returncode = 0
+        mock_subprocess.run.return_value.stdout = "tests/test1.py\n"
+
+        got = client.subset(["tests/test1.py"], "--target 10% --ignore-new-tests", None)
+
+        self.assertEqual(['tests/test1.py'], got)
+        mock_requests.post.assert_not_called()
+
+    def test_subset_native_unreadable_options(self):
+        client, mock_requests, mock_subprocess = self._native_client()
+        mock_subprocess.run.return_value.returncode = 0
+        mock_subprocess.run.return_value.stdout = "tests/test1.py\n"
+
+        got = client.subset(["tests/test1.py"], "--time 1h30m", None)
+
+        self.assertEqual(['tests/test1.py'], got)
+        mock_requests.post.assert_not_called()
+        self.assertEqual(['launchable', 'subset', '--session', 'builds/test/test_sessions/1', '--time', '1h30m', 'file'],
+                         mock_subprocess.run.call_args[0][0])
+
+    def test_split_subset_shared(self):
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+
+        def run(cmd, **kwargs):
+            output = MagicMock(name="output")
+            output.returncode = 0
+            output.stdout = "subset/123\n" if cmd[1] == "subset" else "tests/{}.py\n".format(cmd[-2])
+            return output
+
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_subprocess.run.side_effect = run
+
+        got = []
+        for bin in ["1/2", "2/2"]:
+            client = LaunchableClient(
+                "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), mock_subprocess,
+                TestSessionContext("test", bin[0]), shared_subset_dir=shared_dir)
+            got.append(client.subset(iter(["tests/test1.py", "tests/test2.py"]), "--target 30% --bin " + bin, None))
+
+        self.assertEqual([["tests/1/2.py"], ["tests/2/2.py"]], got)
+        # Only the first shard took the subset
+        commands = [c[0][0] for c in mock_subprocess.run.call_args_list]
+        self.assertEqual(["subset", "split-subset", "split-subset"], [cmd[1] for cmd in commands])
+        self.assertEqual(["1/2", "2/2"], [cmd[-2] for cmd in commands[1:]])
+        self.assertEqual("subset/123", commands[2][3])
+
+    def test_subset_shared(self):
+        shared_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shared_dir)
+
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_subprocess.run.return_value.returncode = 0
+        mock_subprocess.run.return_value.stdout = "tests/test2.py\n"
+
+        got = []
+        for bin in ["1", "2"]:
+            client = LaunchableClient(
+                "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), mock_subprocess,
+                TestSessionContext("test", bin), shared_subset_dir=shared_dir)
+            got.append(client.subset(iter(["tests/test1.py", "tests/test2.py"]), "--target 30%", None))
+
+        # Shards splitting the subset locally get the one the first shard took
+        self.assertEqual([["tests/test2.py"], ["tests/test2.py"]], got)
+        mock_subprocess.run.assert_called_once()
+
+    def test_subset_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        mock_subprocess = MagicMock(name="subprecess")
+        mock_subprocess.run.return_value.returncode = 0
+        mock_subprocess.run.return_value.stdout = "tests/test2.py\n"
+
+        got = []
+        for _ in range(2):
+            # A retry registers a new session of the same build
+            client = LaunchableClient(
+                "base_url", "org_name", "wp_name", "token", MagicMock(name="requests"), mock_subprocess,
+                TestSessionContext("test"), subset_cache=SubsetCache(os.path.join(cache_dir, "subset.json"), 60, 8))
+            client.test_session_context.test_session_id = len(got) + 1
+            got.append(client.subset(iter(["tests/test2.py", "tests/test1.py"]), "--target 10%", None))
+
+        self.assertEqual([["tests/test2.py"], ["tests/test2.py"]], got)
+        mock_subprocess.run.assert_called_once()
+
+        # Different candidates or options are not served from the cache
+        client.subset(["tests/test1.py"], "--target 10%", None)
+        client.subset(["tests/test1.py", "tests/test2.py"], "--target 20%", None)
+        self.assertEqual(3, mock_subprocess.run.call_count)
+
     def test_subset_failure(self):
         mock_output = MagicMock(name="output")
         mock_subprocess = MagicMock(name="subprecess")
@@ -282,10 +550,54 @@ class TestLaunchableClient(unittest.TestCase):
             ]
         }
 
-        mock_requests.post.assert_called_once_with(
-            expected_url, headers=expected_headers, json=expected_body)
+        mock_requests.post.assert_called_once()
+        args, kwargs = mock_requests.post.call_args
+        self.assertEqual((expected_url,), args)
+        self.assertEqual(expected_headers, kwargs["headers"])
+        self.assertEqual(expected_body, json.loads(kwargs["data"].decode("utf-8")))
         mock_response.raise_for_status.assert_called_once_with()
 
+    def _compression_client(self, threshold):
+        mock_requests = MagicMock(name="requests")
+        mock_context = TestSessionContext("test", 1)
+
+        client = LaunchableClient("base_url", "org_name", "wp_name", "token", mock_requests,
+                                  MagicMock(name="subprecess"), mock_context,
+                                  compression=LaunchableClient.GZIP, compression_threshold=threshold)
+
+        mock_component = MagicMock(name="test_path_component")
+        mock_component.to_body.return_value = {"type": "file", "name": "test1.py"}
+        events = [CaseEvent([mock_component], 0.1, CaseEvent.TEST_PASSED, "stdout" * 100, "")]
+
+        return client, mock_requests, events
+
+    def test_upload_events_compressed(self):
+        client, mock_requests, events = self._compression_client(100)
+
+        client.upload_events(events)
+
+        _, kwargs = mock_requests.post.call_args
+        self.assertEqual(LaunchableClient.GZIP, kwargs["headers"]["Content-Encoding"])
+
+        body = json.loads(gzip.decompress(kwargs["data"]).decode("utf-8"))
+        self.assertEqual("stdout" * 100, body["events"][0]["stdout"])
+
+        self.assertEqual(len(gzip.decompress(kwargs["data"])), client.raw_bytes)
+        self.assertEqual(len(kwargs["data"]), client.sent_bytes)
+        self.assertLess(client.sent_bytes, client.raw_bytes)
+
+    def test_upload_events_below_compression_threshold(self):
+        client, mock_requests, events = self._compression_client(1024 * 1024)
+
+        client.upload_events(events)
+
+        _, kwargs = mock_requests.post.call_args
+        self.assertNotIn("Content-Encoding", kwargs["headers"])
+
+        body = json.loads(kwargs["data"].decode("utf-8"))
+        self.assertEqual("stdout" * 100, body["events"][0]["stdout"])
+        self.assertEqual(client.raw_bytes, client.sent_bytes)
+
     def test_finish(self):
         mock_response = MagicMock(name="response")
         mock_requests = MagicMock(name="requests")
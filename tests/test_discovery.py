@@ -0,0 +1,229 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from nose.config import Config
+
+from nose_launchable.discovery import DiscoveryCache, discover_test_files, scan_test_files, _scan
+
+
+class TestDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ["tests/test_a.py", "tests/helper.py", "tests/_private/test_x.py", "tests/pkg/__init__.py",
+                     "tests/pkg/test_b.py", "lib/test_c.py", "test_d.py", "setup.py"]:
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("raise RuntimeError('must not be imported')\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _discover(self, *names):
+        conf = Config(workingDir=self.root)
+        conf.testNames = list(names)
+        files = discover_test_files(conf)
+        return None if files is None else [os.path.relpath(f, self.root) for f in files]
+
+    def test_discover(self):
+        # lib is one of nose's default source directories, and names matching testMatch come last like in nose
+        self.assertEqual(["lib/test_c.py", "test_d.py", "tests/pkg/test_b.py", "tests/test_a.py"], self._discover())
+
+    def test_discover_names(self):
+        self.assertEqual(["tests/pkg/test_b.py", "lib/test_c.py"], self._discover("tests/pkg", "lib/test_c.py:test"))
+
+    def test_discover_unresolvable(self):
+        self.assertIsNone(self._discover("no_such_module"))
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.conf = Config()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, source):
+        path = os.path.join(self.root, name)
+        with open(path, "w") as f:
+            f.write(source)
+        return path
+
+    def test_scan(self):
+        path = self._write("test_a.py", """
+import unittest
+from helpers import test_shared, other
+
+raise RuntimeError('must not be imported')
+
+def test_function():
+    pass
+
+def helper():
+    pass
+
+def _test_private():
+    pass
+
+class Base(object):
+    pass
+
+class Mixin:
+    pass
+
+class Derived(Base):
+    pass
+
+class Case(unittest.TestCase):
+    pass
+
+class Inherited(Case):
+    pass
+
+class Checks:
+    __test__ = False
+
+class TestNotCollected:
+    __test__ = False
+""")
+
+        want = ["test_shared", "test_function", "Case", "Inherited"]
+        self.assertEqual({path: want}, scan_test_files([path], self.conf.testMatch))
+
+    def test_scan_nested(self):
+        path = self._write("test_nested.py", """
+import sys
+import unittest
+
+if sys.version_info >= (3, 8):
+    def test_new():
+        pass
+else:
+    def test_new():
+        pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    class NumpyCase(unittest.TestCase):
+        pass
+
+with open(__file__):
+    def test_with():
+        pass
+
+class Declared:
+    __test__ = True
+
+class _Private:
+    __test__ = True
+
+if numpy is None:
+    class TestSometimes:
+        __test__ = False
+""")
+
+        # TestSometimes always declares it is not a test
+        want = ["test_new", "NumpyCase", "test_with", "Declared", "_Private"]
+        self.assertEqual({path: want}, scan_test_files([path], self.conf.testMatch))
+
+    def test_scan_declared(self):
+        disabled = self._write("test_disabled.py", "__test__ = bool(0)\ndef test_a():\n    pass\n")
+        conditional = self._write("test_conditional.py", "import os\nif os.name == 'nt':\n    __test__ = False\n"
+                                                         "def test_a():\n    pass\n")
+
+        # Neither is known to be false without running the module
+        self.assertEqual({disabled: ["test_a"], conditional: ["test_a"]},
+                         scan_test_files([disabled, conditional], self.conf.testMatch))
+
+    def test_scan_no_tests(self):
+        path = self._write("test_util.py", "def helper():\n    pass\n")
+        disabled = self._write("test_disabled.py", "__test__ = False\ndef test_a():\n    pass\n")
+
+        self.assertEqual({path: [], disabled: []}, scan_test_files([path, disabled], self.conf.testMatch))
+
+    def test_scan_syntax_error(self):
+        path = self._write("test_broken.py", "def test_a(:\n")
+
+        self.assertEqual({path: None}, scan_test_files([path], self.conf.testMatch))
+
+    def test_scan_workers(self):
+        paths = [self._write("test_{}.py".format(i), "def test_{}():\n    pass\n".format(i)) for i in range(40)]
+
+        got = scan_test_files(paths, self.conf.testMatch, workers=2)
+
+        self.assertEqual({path: ["test_{}".format(i)] for i, path in enumerate(paths)}, got)
+
+    def test_scan_with_threads(self):
+        paths = [self._write("test_{}.py".format(i), "def test_{}():\n    pass\n".format(i)) for i in range(40)]
+
+        # Forking now could copy a lock held by the other thread
+        with patch("nose_launchable.discovery.threading.active_count", return_value=2), \
+                patch("nose_launchable.discovery.ProcessPoolExecutor") as executor:
+            got = scan_test_files(paths, self.conf.testMatch, workers=2)
+
+        executor.assert_not_called()
+        self.assertEqual({path: ["test_{}".format(i)] for i, path in enumerate(paths)}, got)
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.conf = Config()
+        self.path = os.path.join(self.root, "test_a.py")
+        self._write("def test_a():\n    pass\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, source, mtime=None):
+        with open(self.path, "w") as f:
+            f.write(source)
+        if mtime is not None:
+            os.utime(self.path, ns=(mtime, mtime))
+
+    def _scan(self):
+        cache = DiscoveryCache.load(self.conf.testMatch, self.root)
+        with patch("nose_launchable.discovery._scan", wraps=_scan) as scan:
+            got = scan_test_files([self.path], self.conf.testMatch, cache=cache)
+        cache.save()
+        return got[self.path], scan.call_count
+
+    def test_cache(self):
+        self.assertEqual((["test_a"], 1), self._scan())
+        self.assertTrue(os.path.exists(os.path.join(self.root, ".launchable", "discovery.json")))
+
+        self.assertEqual((["test_a"], 0), self._scan())
+
+    def test_cache_changed(self):
+        self._scan()
+        self._write("def test_b():\n    pass\n", mtime=1)
+
+        self.assertEqual((["test_b"], 1), self._scan())
+
+    def test_cache_touched(self):
+        self._scan()
+        # Same content with a new mtime, e.g. after a fresh checkout
+        self._write("def test_a():\n    pass\n", mtime=1)
+
+        self.assertEqual((["test_a"], 0), self._scan())
+
+    def test_cache_test_match_changed(self):
+        self._scan()
+        self.conf.testMatch = re.compile("check")
+
+        self.assertEqual(([], 1), self._scan())
+
+    def test_cache_broken(self):
+        os.makedirs(os.path.join(self.root, ".launchable"))
+        with open(os.path.join(self.root, ".launchable", "discovery.json"), "w") as f:
+            f.write("{")
+
+        self.assertEqual((["test_a"], 1), self._scan())
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from nose_launchable.case_event import CaseEvent
+from nose_launchable.history import History, HistoryFactory, HistoryRecorder, format_test_path, \
+    load_file_durations
+from nose_launchable.test_path_component import TestPathComponent
+
+
+def _path(file, case):
+    return [TestPathComponent(TestPathComponent.FILE_TYPE, file), TestPathComponent(TestPathComponent.CASE_TYPE, case)]
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, ".launchable", "history.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_add(self):
+        history = History(self.path)
+        history.add([
+            (_path("tests/test_a.py", "test_a"), CaseEvent.TEST_PASSED, 1.0),
+            (_path("tests/test_a.py", "test_b"), CaseEvent.TEST_SKIPPED, 0.0),
+            (_path("tests/test_b.py", "test_c"), CaseEvent.TEST_FAILED, 4.0),
+        ])
+        history.add([(_path("tests/test_a.py", "test_a"), CaseEvent.TEST_FAILED, 3.0)])
+        history.close()
+
+        history = History(self.path)
+        self.assertEqual({"tests/test_a.py": 2.0, "tests/test_b.py": 4.0}, history.file_durations())
+
+        test_path, runs, mean, stdev, failed = history.slowest(1)[0]
+        self.assertEqual(("file=tests/test_b.py#testcase=test_c", 1, 4.0, 0.0, 1),
+                         (test_path, runs, mean, stdev, failed))
+
+        test_path, runs, mean, stdev, failed = history.slowest(2)[1]
+        self.assertEqual(("file=tests/test_a.py#testcase=test_a", 2, 2.0, 1), (test_path, runs, mean, failed))
+        self.assertAlmostEqual(2 ** 0.5, stdev)
+
+    def test_load_file_durations(self):
+        self.assertEqual({}, load_file_durations(self.path))
+        # Reading does not create the file
+        self.assertFalse(os.path.exists(self.path))
+
+        history = History(self.path)
+        history.add([(_path("tests/test_a.py", "test_a"), CaseEvent.TEST_PASSED, 1.5)])
+        history.close()
+
+        self.assertEqual({"tests/test_a.py": 1.5}, load_file_durations(self.path))
+
+    def test_format_test_path(self):
+        test_path = [TestPathComponent(TestPathComponent.FILE_TYPE, "tests/test_a.py"),
+                     TestPathComponent(TestPathComponent.CLASS_TYPE, "TestA"),
+                     TestPathComponent(TestPathComponent.CASE_TYPE, "test_a")]
+
+        self.assertEqual("file=tests/test_a.py#class=TestA#testcase=test_a", format_test_path(test_path))
+
+    def test_recorder(self):
+        recorder = HistoryRecorder(self.path, batch_size=2, interval=0.01)
+        recorder.start()
+        for i in range(5):
+            recorder.record(CaseEvent(_path("tests/test_a.py", "test_{}".format(i)), float(i), CaseEvent.TEST_PASSED,
+                                      "", ""))
+        recorder.join(5)
+
+        history = History(self.path)
+        self.assertEqual({"tests/test_a.py": 10.0}, history.file_durations())
+        history.close()
+
+    def test_recorder_cannot_open(self):
+        # A directory cannot be opened as a database
+        os.makedirs(self.path)
+        recorder = HistoryRecorder(self.path)
+        recorder.start()
+        recorder._thread.join(5)
+
+        recorder.record(CaseEvent(_path("tests/test_a.py", "test_a"), 1.0, CaseEvent.TEST_PASSED, "", ""))
+        self.assertTrue(recorder._queue.empty())
+        recorder.join()
+
+    def test_factory(self):
+        with patch.dict(os.environ, {"LAUNCHABLE_HISTORY_FILE": self.path}):
+            self.assertEqual(self.path, HistoryFactory.prepare().path)
+
+        with patch.dict(os.environ, {"LAUNCHABLE_HISTORY_FILE": ""}):
+            self.assertIsNone(HistoryFactory.prepare())
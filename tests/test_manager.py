@@ -5,7 +5,7 @@ from .resources.module2 import MockTestClass2
 
 from nose.suite import ContextSuite
 from nose.suite import Test
-from nose_launchable.manager import get_test_names, subset
+from nose_launchable.manager import build_index, get_test_names, subset
 
 
 class TestManager(unittest.TestCase):
@@ -52,3 +52,52 @@ class TestManager(unittest.TestCase):
 
         got = get_test_names(self.mock_suite0)
         self.assertEqual(want, got)
+
+    def test_build_index(self):
+        index = build_index(self.mock_suite0)
+
+        self.assertEqual(['tests/resources/module0.py', 'tests/resources/module1.py', 'tests/resources/module2.py'],
+                         index.names)
+
+        (leaf, ancestors), = index.leaves['tests/resources/module2.py']
+        self.assertIs(MockTestClass2, leaf.context)
+        self.assertEqual((self.mock_suite0, self.mock_suite1), ancestors)
+
+    def test_subset_with_index(self):
+        want = ['tests/resources/module1.py']
+
+        index = build_index(self.mock_suite0)
+        subset(self.mock_suite0, set(want), index)
+
+        got = get_test_names(self.mock_suite0)
+        self.assertEqual(want, got)
+        self.assertEqual([self.mock_suite1], list(self.mock_suite0))
+
+    def test_deep_tree(self):
+        def func():
+            print("called")
+
+        suite = ContextSuite(tests=[Test(func)], context=MockTestClass1)
+        for _ in range(5000):
+            suite = ContextSuite(tests=[suite])
+        root = ContextSuite(tests=[ContextSuite(tests=[Test(func)], context=MockTestClass0), suite])
+
+        self.assertEqual(['tests/resources/module0.py', 'tests/resources/module1.py'], get_test_names(root))
+
+        subset(root, {'tests/resources/module1.py'})
+
+        self.assertEqual(['tests/resources/module1.py'], get_test_names(root))
+
+    def test_subset_ordered(self):
+        subset(self.mock_suite0, ['tests/resources/module2.py', 'tests/resources/module0.py', 'tests/resources/module1.py'])
+
+        # module2 ranks first, so the suite holding module1 and module2 runs before module0
+        got = get_test_names(self.mock_suite0)
+        self.assertEqual(['tests/resources/module2.py', 'tests/resources/module1.py', 'tests/resources/module0.py'], got)
+        self.assertIs(self.mock_suite1, list(self.mock_suite0)[0])
+
+    def test_subset_ordered_partial(self):
+        subset(self.mock_suite0, ['tests/resources/module2.py', 'tests/resources/module0.py'])
+
+        got = get_test_names(self.mock_suite0)
+        self.assertEqual(['tests/resources/module2.py', 'tests/resources/module0.py'], got)
@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import unittest
+
+from nose_launchable.metrics import Metrics, summarize
+
+
+class TestMetrics(unittest.TestCase):
+    def test_report(self):
+        m = Metrics()
+        m.increment("retries")
+        m.increment("retries", 2)
+        m.observe("batch_events", 3)
+        m.observe("batch_events", 1)
+        m.record("queue_depth", 10)
+        with m.timer("join_seconds"):
+            pass
+
+        report = m.report()
+
+        self.assertEqual({"retries": 3}, report["counters"])
+        self.assertEqual(2, report["histograms"]["batch_events"]["count"])
+        self.assertEqual(4, report["histograms"]["batch_events"]["sum"])
+        self.assertEqual(1, report["histograms"]["join_seconds"]["count"])
+        self.assertEqual([10], [v for _, v in report["series"]["queue_depth"]])
+
+    def test_reset(self):
+        m = Metrics()
+        m.increment("retries")
+        m.reset()
+
+        self.assertEqual({}, m.report()["counters"])
+
+    def test_summarize(self):
+        summary = summarize(list(range(1, 101)))
+
+        self.assertEqual(1, summary["min"])
+        self.assertEqual(100, summary["max"])
+        self.assertEqual(50, summary["p50"])
+        self.assertEqual(90, summary["p90"])
+        self.assertEqual(99, summary["p99"])
+        self.assertEqual({"count": 0}, summarize([]))
+
+    def test_dump(self):
+        m = Metrics()
+        m.increment("retries")
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "metrics.json")
+            m.dump(path)
+
+            with open(path) as f:
+                self.assertEqual({"retries": 1}, json.load(f)["counters"])
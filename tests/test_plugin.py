@@ -0,0 +1,272 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from nose.suite import ContextSuite, Test
+
+from nose_launchable.capture import CaptureBufferFactory
+from nose_launchable.manager import get_test_names
+from nose_launchable.case_event import CaseEvent
+from nose_launchable.plugin import Launchable, CAPTURE_ALL, CAPTURE_FAILURES
+from nose_launchable.prefetch import SubsetPrefetch
+from .resources.module0 import MockTestClass0
+from .resources.module1 import MockTestClass1
+from .resources.module2 import MockTestClass2
+
+
+def _plugin(capture_policy, nose_capture=None):
+    plugin = Launchable()
+    plugin.capture_policy = capture_policy
+    plugin._buffers = CaptureBufferFactory(100, 100)
+    plugin._noseCapture = nose_capture
+    plugin._stdoutFromNose = nose_capture is not None
+    return plugin
+
+
+class _Test:
+    pass
+
+
+def _noop():
+    pass
+
+
+class TestLaunchableCapture(unittest.TestCase):
+    def _run(self, plugin):
+        plugin._startCapture()
+        try:
+            print("out")
+        finally:
+            plugin._endCapture()
+
+    def test_capture_all(self):
+        plugin = _plugin(CAPTURE_ALL)
+        self._run(plugin)
+
+        self.assertEqual(("out\n", ""), plugin._getCapturedOutput(MagicMock(), CaseEvent.TEST_PASSED))
+
+    def test_capture_failures(self):
+        plugin = _plugin(CAPTURE_FAILURES)
+        self._run(plugin)
+
+        self.assertEqual(("", ""), plugin._getCapturedOutput(MagicMock(), CaseEvent.TEST_PASSED))
+        self.assertEqual(("", ""), plugin._getCapturedOutput(MagicMock(), CaseEvent.TEST_SKIPPED))
+        self.assertEqual(("out\n", ""), plugin._getCapturedOutput(MagicMock(), CaseEvent.TEST_FAILED))
+
+    def test_capture_failures_with_nose_capture(self):
+        plugin = _plugin(CAPTURE_FAILURES, MagicMock(name="capture"))
+        self._run(plugin)
+
+        test = _Test()
+        test.capturedOutput = "captured by nose\n"
+
+        self.assertIsNone(plugin._currentStdout)
+        self.assertEqual(("captured by nose\n", ""), plugin._getCapturedOutput(test, CaseEvent.TEST_FAILED))
+
+    def test_capture_from_nose(self):
+        nose_capture = MagicMock(name="capture")
+        nose_capture.buffer = "passing output\n"
+        plugin = _plugin(CAPTURE_ALL, nose_capture)
+        self._run(plugin)
+
+        self.assertIsNone(plugin._currentStdout)
+        self.assertEqual(("passing output\n", ""), plugin._getCapturedOutput(_Test(), CaseEvent.TEST_PASSED))
+        self.assertEqual(("capt\n", ""), plugin._getCapturedOutput(_Test(), CaseEvent.TEST_PASSED, "capt\n"))
+
+
+def _subset_plugin(targets):
+    plugin = Launchable()
+    plugin.subset_options = None
+    plugin.subset_target = "50"
+    plugin.conf = MagicMock(workingDir="/work")
+    plugin._client = MagicMock()
+
+    plugin.received = []
+
+    def subset(names, options, target):
+        plugin.received.extend(names)
+        if isinstance(targets, Exception):
+            raise targets
+        return targets
+
+    plugin._client.subset.side_effect = subset
+    plugin._prefetch = SubsetPrefetch(plugin._client, plugin.subset_options, plugin.subset_target)
+    plugin._prefetch.start()
+    return plugin
+
+
+class TestLaunchableFinalize(unittest.TestCase):
+    def test_metrics_dumped_when_finish_fails(self):
+        plugin = Launchable()
+        plugin._uploaderStarted = True
+        plugin._uploader = MagicMock(name="uploader")
+        plugin._client = MagicMock(name="client")
+        plugin._client.finish.side_effect = RuntimeError("finish failed")
+
+        with patch("nose_launchable.plugin.metrics.dump") as dump, patch("nose_launchable.protecter.handleError"):
+            plugin.finalize(None)
+
+        dump.assert_called_once()
+
+
+class TestLaunchableSubsetEarly(unittest.TestCase):
+    def test_subset_early(self):
+        plugin = _subset_plugin(["tests/pkg/test_b.py"])
+
+        files = ["/work/tests/test_a.py", "/work/tests/pkg/test_b.py", "/work/lib/test_c.py", "/work/tests/test_util.py"]
+        tests = {"/work/tests/test_a.py": ["test_a"], "/work/tests/pkg/test_b.py": ["TestB"],
+                 "/work/lib/test_c.py": None, "/work/tests/test_util.py": []}
+        with patch("nose_launchable.plugin.discover_test_files", return_value=files), \
+                patch("nose_launchable.plugin.scan_test_files", return_value=tests):
+            plugin._subsetEarly()
+
+        self.assertFalse(plugin.wantFile("/work/tests/test_a.py"))
+        self.assertIsNone(plugin.wantFile("/work/tests/pkg/test_b.py"))
+        # Loaded anyway, in case they have tests the scan could not see, or to report their errors
+        self.assertIsNone(plugin.wantFile("/work/tests/test_util.py"))
+        self.assertIsNone(plugin.wantFile("/work/lib/test_c.py"))
+        # Not found by discovery, so nose decides
+        self.assertIsNone(plugin.wantFile("/work/tests/test_doc.txt"))
+
+        self.assertIsNone(plugin.wantDirectory("/work/tests"))
+        self.assertIsNone(plugin.wantDirectory("/work/tests/pkg"))
+        self.assertIsNone(plugin.wantDirectory("/work/lib"))
+
+        # test_util.py has no tests, and test_c.py could not be parsed so nose will report it
+        self.assertEqual(["tests/test_a.py", "tests/pkg/test_b.py", "lib/test_c.py"], plugin.received)
+        self.assertEqual(["tests/pkg/test_b.py"], plugin._early_targets)
+        self.assertEqual(["tests/test_util.py"], plugin._early_kept)
+
+    def test_subset_early_failure(self):
+        plugin = _subset_plugin(RuntimeError("launchable subset command fails"))
+
+        with patch("nose_launchable.plugin.discover_test_files", return_value=["/work/tests/test_a.py"]), \
+                patch("nose_launchable.plugin.scan_test_files", return_value={"/work/tests/test_a.py": ["test_a"]}):
+            plugin._subsetEarly()
+
+        # Every file is loaded
+        self.assertIsNone(plugin.wantFile("/work/tests/test_a.py"))
+        self.assertIsNone(plugin._early_targets)
+
+    def test_subset_early_unresolvable(self):
+        plugin = _subset_plugin(["tests/test_a.py"])
+
+        with patch("nose_launchable.plugin.discover_test_files", return_value=None):
+            plugin._subsetEarly()
+
+        self.assertIsNone(plugin._early_targets)
+        self.assertIsNone(plugin.wantFile("/work/tests/test_a.py"))
+
+        # Names are sent once the tree is loaded
+        suite = ContextSuite(tests=[ContextSuite(tests=[Test(_noop)], context=MockTestClass0)])
+        plugin._subset(suite)
+
+        self.assertEqual(["tests/resources/module0.py"], plugin.received)
+
+
+class TestLaunchableLocalSplit(unittest.TestCase):
+    def _suite(self):
+        return ContextSuite(tests=[ContextSuite(tests=[Test(_noop)], context=c)
+                                   for c in [MockTestClass0, MockTestClass1, MockTestClass2]])
+
+    def _configure(self, env):
+        options = MagicMock(name="options", subset_enabled=True, record_only_enabled=False, build_number="1",
+                            test_session=None, subset_target="30", subset_options=None, subset_early=False,
+                            local_split="1/2", capture_policy=None, capture_source=None)
+
+        plugin = Launchable()
+        with patch.dict("os.environ", env, clear=True), \
+                patch("nose_launchable.plugin.LaunchableClientFactory.prepare"), \
+                patch("nose_launchable.plugin.UploaderFactory.prepare"), \
+                patch("nose_launchable.plugin.HistoryFactory.prepare"), \
+                patch("nose_launchable.plugin.CaptureBufferFactory.prepare"):
+            plugin.configure(options, MagicMock(name="conf"))
+
+        return plugin
+
+    def test_local_split_subset_configure(self):
+        self.assertTrue(self._configure({"LAUNCHABLE_TOKEN": "token",
+                                         "LAUNCHABLE_SHARED_SUBSET_DIR": "/shared"}).enabled)
+        # Shards could take different subsets, so their bins would not cover the suite
+        self.assertFalse(self._configure({"LAUNCHABLE_TOKEN": "token"}).enabled)
+
+    def test_local_split_record_only(self):
+        durations = {"tests/resources/module0.py": 1.0, "tests/resources/module1.py": 5.0,
+                     "tests/resources/module2.py": 3.0}
+
+        names = []
+        for index in [1, 2]:
+            plugin = Launchable()
+            plugin.subset_enabled = False
+            plugin.local_split = (index, 2)
+            plugin._uploaderStarted = True
+
+            suite = self._suite()
+            with patch("nose_launchable.plugin.load_file_durations", return_value=durations):
+                plugin.prepareTest(suite)
+            names.append(get_test_names(suite))
+
+        self.assertEqual([["tests/resources/module1.py"],
+                          ["tests/resources/module0.py", "tests/resources/module2.py"]], names)
+
+    def test_local_split_without_session(self):
+        plugin = Launchable()
+        plugin.subset_enabled = False
+        plugin.local_split = (2, 2)
+        plugin._uploader = MagicMock(name="uploader")
+        plugin._prefetch = MagicMock(name="prefetch")
+        plugin._prefetch.wait_session.side_effect = RuntimeError("API is down")
+
+        suite = self._suite()
+        with patch("nose_launchable.plugin.load_file_durations", return_value={}), \
+                patch("nose_launchable.protecter.handleError") as handle_error:
+            plugin.prepareTest(suite)
+
+        # Split all the same
+        self.assertEqual(["tests/resources/module1.py"], get_test_names(suite))
+        handle_error.assert_called_once()
+        plugin._uploader.start.assert_not_called()
+
+    def test_local_split_subset_failure(self):
+        plugin = _subset_plugin(RuntimeError("launchable subset command fails"))
+        plugin.subset_enabled = True
+        plugin.local_split = (1, 2)
+        plugin._uploader = MagicMock(name="uploader")
+
+        suite = self._suite()
+        with patch("nose_launchable.plugin.load_file_durations", return_value={}), \
+                patch("nose_launchable.protecter.handleError") as handle_error:
+            plugin.prepareTest(suite)
+
+        # The whole suite is split instead of the subset
+        self.assertEqual(["tests/resources/module0.py", "tests/resources/module2.py"], get_test_names(suite))
+        handle_error.assert_called_once()
+        plugin._uploader.start.assert_called_once_with()
+
+    def test_local_split_subset(self):
+        plugin = _subset_plugin(["tests/resources/module2.py", "tests/resources/module0.py",
+                                 "tests/resources/module1.py"])
+        plugin.local_split = (1, 2)
+
+        suite = self._suite()
+        with patch("nose_launchable.plugin.load_file_durations", return_value={}):
+            plugin._subset(suite)
+
+        # Bins keep the order of the subset
+        self.assertEqual(["tests/resources/module2.py", "tests/resources/module0.py"], get_test_names(suite))
+
+    def test_local_split_early(self):
+        plugin = _subset_plugin(["tests/test_b.py", "tests/test_a.py"])
+        plugin.local_split = (2, 2)
+
+        files = ["/work/tests/test_a.py", "/work/tests/test_b.py"]
+        tests = {"/work/tests/test_a.py": ["test_a"], "/work/tests/test_b.py": ["test_b"]}
+        with patch("nose_launchable.plugin.discover_test_files", return_value=files), \
+                patch("nose_launchable.plugin.scan_test_files", return_value=tests), \
+                patch("nose_launchable.plugin.load_file_durations", return_value={}):
+            plugin._subsetEarly()
+
+            # Files of the other bin are never imported
+            self.assertFalse(plugin.wantFile("/work/tests/test_a.py"))
+            self.assertIsNone(plugin.wantFile("/work/tests/test_b.py"))
+
+        self.assertEqual(["tests/test_b.py"], plugin._early_targets)
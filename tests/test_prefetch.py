@@ -0,0 +1,68 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from nose_launchable.prefetch import SubsetPrefetch
+
+
+class TestSubsetPrefetch(unittest.TestCase):
+    def test_prefetch(self):
+        client = MagicMock(name="client")
+        received = []
+        consumed = threading.Event()
+
+        def subset(names, options, target):
+            for name in names:
+                received.append(name)
+                consumed.set()
+            return list(reversed(received))
+
+        client.subset.side_effect = subset
+
+        prefetch = SubsetPrefetch(client, None, "10")
+        prefetch.start()
+        prefetch.wait_session()
+        client.start.assert_called_once_with()
+
+        prefetch.add("tests/test1.py")
+        # Names are consumed before the last one is added
+        self.assertTrue(consumed.wait(5))
+        prefetch.add("tests/test2.py")
+
+        self.assertEqual(["tests/test2.py", "tests/test1.py"], prefetch.result())
+        client.subset.assert_called_once()
+
+    def test_session_only(self):
+        client = MagicMock(name="client")
+
+        prefetch = SubsetPrefetch(client, subset=False)
+        prefetch.start()
+
+        self.assertIsNone(prefetch.result())
+        client.start.assert_called_once_with()
+        client.subset.assert_not_called()
+
+    def test_subset_failure(self):
+        client = MagicMock(name="client")
+        client.subset.side_effect = RuntimeError("subset")
+
+        prefetch = SubsetPrefetch(client, None, "10")
+        prefetch.start()
+
+        with self.assertRaises(RuntimeError):
+            prefetch.result()
+        # Results can still be uploaded to the session
+        prefetch.wait_session()
+
+    def test_session_failure(self):
+        client = MagicMock(name="client")
+        client.start.side_effect = RuntimeError("session")
+
+        prefetch = SubsetPrefetch(client, None, "10")
+        prefetch.start()
+
+        with self.assertRaises(RuntimeError):
+            prefetch.wait_session()
+        with self.assertRaises(RuntimeError):
+            prefetch.result()
+        client.subset.assert_not_called()
@@ -0,0 +1,51 @@
+import os
+import unittest
+from unittest import mock
+
+from nose_launchable.profiler import HookProfiler, PROFILE_HOOKS_KEY
+
+
+class TestHookProfiler(unittest.TestCase):
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            profiler = HookProfiler()
+
+        @profiler.hook
+        def beforeTest():
+            return "result"
+
+        self.assertEqual("result", beforeTest())
+        self.assertEqual({}, profiler.samples)
+
+    @mock.patch.dict(os.environ, {PROFILE_HOOKS_KEY: "1"})
+    def test_enabled(self):
+        profiler = HookProfiler()
+
+        @profiler.hook
+        def beforeTest():
+            return "result"
+
+        @profiler.hook
+        def afterTest():
+            raise RuntimeError()
+
+        self.assertEqual("result", beforeTest())
+        beforeTest()
+        with self.assertRaises(RuntimeError):
+            afterTest()
+
+        self.assertEqual(2, len(profiler.samples["beforeTest"]))
+        self.assertEqual(1, len(profiler.samples["afterTest"]))
+        self.assertEqual(2, sum(profiler.histogram("beforeTest")))
+
+        report = profiler.format_report(10)
+        self.assertIn("beforeTest: calls: 2", report)
+        self.assertIn("afterTest: calls: 1", report)
+        self.assertIn("of 10.000s suite wall time", report)
+
+    @mock.patch.dict(os.environ, {PROFILE_HOOKS_KEY: "1"})
+    def test_histogram(self):
+        profiler = HookProfiler()
+        profiler.samples["addSuccess"] = [0.000001, 0.0005, 0.0005, 1]
+
+        self.assertEqual([1, 0, 2, 0, 0, 1], profiler.histogram("addSuccess"))
@@ -0,0 +1,50 @@
+import json
+import unittest
+from unittest import mock
+
+from nose_launchable import serializer
+from nose_launchable.capture import SpillBuffer
+from nose_launchable.case_event import CaseEvent
+from nose_launchable.serializer import encode_event, serialize_events
+from nose_launchable.test_path_component import TestPathComponent
+
+
+class TestSerializer(unittest.TestCase):
+    def setUp(self):
+        self.events = [
+            CaseEvent([TestPathComponent(TestPathComponent.FILE_TYPE, "tests/test1.py"),
+                       TestPathComponent(TestPathComponent.CASE_TYPE, "test_a")],
+                      0.1, CaseEvent.TEST_PASSED, "stdout あ\n", ""),
+            CaseEvent([TestPathComponent(TestPathComponent.FILE_TYPE, "tests/test2.py")],
+                      0.2, CaseEvent.TEST_FAILED, "", "stderr \"quoted\""),
+        ]
+
+    def test_encode_event(self):
+        self.assertEqual(self.events[0].to_body(), json.loads(encode_event(self.events[0]).decode("utf-8")))
+
+    def test_serialize_events(self):
+        got = json.loads(serialize_events(self.events).decode("utf-8"))
+
+        self.assertEqual({"events": [e.to_body() for e in self.events]}, got)
+
+    def test_serialize_events_empty(self):
+        self.assertEqual(b'{"events":[]}', serialize_events([]))
+
+    def test_serialize_events_without_fast_backend(self):
+        with mock.patch.object(serializer, "orjson", None):
+            got = json.loads(serialize_events(self.events).decode("utf-8"))
+
+        self.assertEqual({"events": [e.to_body() for e in self.events]}, got)
+
+    def test_serialize_spilled_output(self):
+        buffer = SpillBuffer(1)
+        buffer.write("spilled \"output\" あ\n")
+
+        event = CaseEvent([TestPathComponent(TestPathComponent.FILE_TYPE, "tests/test1.py")],
+                          0.1, CaseEvent.TEST_FAILED, buffer.getvalue(), "")
+
+        got = json.loads(serialize_events([event]).decode("utf-8"))
+
+        self.assertEqual("spilled \"output\" あ\n", got["events"][0]["stdout"])
+        self.assertEqual(event.to_body(), got["events"][0])
+        self.assertEqual(serialize_events([event])[len(b'{"events":['):-2], event.encoded)
@@ -0,0 +1,43 @@
+import unittest
+
+from nose_launchable.splitter import parse_bin, split
+
+
+class TestSplitter(unittest.TestCase):
+    def test_split(self):
+        durations = {"a.py": 7.0, "b.py": 5.0, "c.py": 4.0, "d.py": 3.0, "e.py": 2.0, "f.py": 1.0}
+        bins = split(["f.py", "e.py", "d.py", "c.py", "b.py", "a.py"], durations, 2)
+
+        # a: 7 -> bin 0, b: 5 -> bin 1, c: 4 -> bin 1, d: 3 -> bin 0, e: 2 -> bin 1, f: 1 -> bin 0
+        self.assertEqual([["f.py", "d.py", "a.py"], ["e.py", "c.py", "b.py"]], bins)
+        self.assertEqual([11.0, 11.0], [sum(durations[name] for name in b) for b in bins])
+
+    def test_split_without_history(self):
+        # Unknown files count as the mean of the known ones, 3.0
+        bins = split(["a.py", "b.py", "c.py", "d.py"], {"a.py": 5.0, "b.py": 1.0}, 2)
+        self.assertEqual([["a.py", "b.py"], ["c.py", "d.py"]], bins)
+
+        # With no history at all every file counts the same, and ties go by name
+        bins = split(["d.py", "c.py", "b.py", "a.py", "e.py"], {}, 3)
+        self.assertEqual([["d.py", "a.py"], ["b.py", "e.py"], ["c.py"]], bins)
+
+    def test_split_deterministic(self):
+        names = ["t{}.py".format(i) for i in range(100)]
+        durations = {name: float(i % 7) for i, name in enumerate(names)}
+
+        bins = split(names, durations, 4)
+        self.assertEqual(sorted(names), sorted(name for b in bins for name in b))
+
+        # The bins do not depend on the order names are collected in
+        reordered = split(list(reversed(names)), durations, 4)
+        self.assertEqual([set(b) for b in bins], [set(b) for b in reordered])
+
+    def test_split_more_bins_than_names(self):
+        self.assertEqual([["a.py"], [], []], split(["a.py", "a.py"], {}, 3))
+
+    def test_parse_bin(self):
+        self.assertEqual((2, 5), parse_bin("2/5"))
+
+        for value in ["0/5", "6/5", "2", "a/b"]:
+            with self.assertRaises(ValueError):
+                parse_bin(value)
@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, call
+
+from nose_launchable import spool
+from nose_launchable.spool import Spool, resend
+
+
+def _crash(s):
+    # Simulates a killed process: nothing is cleaned up but the lock is released
+    s._file.close()
+    spool._unlock(s._lock)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_close_removes_delivered_spool(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        s.ack(s.append(b"batch1"))
+        s.ack(s.append(b"batch2"))
+        s.close()
+
+        self.assertEqual([], os.listdir(self.root))
+
+    def test_resend_unacked_batches(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        s.ack(s.append(b"batch1"))
+        s.append(b"batch2")
+        s.append(b"batch3")
+        _crash(s)
+
+        upload = MagicMock(name="upload")
+        self.assertEqual(2, resend(self.root, upload))
+
+        upload.assert_has_calls([
+            call(b"batch2", "builds/test/test_sessions/1"),
+            call(b"batch3", "builds/test/test_sessions/1"),
+        ])
+        self.assertEqual([], os.listdir(self.root))
+
+    def test_ack_out_of_order(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        s.append(b"batch1")
+        r2 = s.append(b"batch2")
+        r3 = s.append(b"batch3")
+        s.ack(r2)
+        s.ack(r3)
+        _crash(s)
+
+        upload = MagicMock(name="upload")
+        resend(self.root, upload)
+
+        # batch2 and batch3 are after the unacknowledged batch1, so they are sent again too
+        upload.assert_has_calls([
+            call(b"batch1", "builds/test/test_sessions/1"),
+            call(b"batch2", "builds/test/test_sessions/1"),
+            call(b"batch3", "builds/test/test_sessions/1"),
+        ])
+
+    def test_rotate_and_remove_delivered_segments(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1", max_segment_bytes=1)
+        s.ack(s.append(b"batch1"))
+        s.ack(s.append(b"batch2"))
+        s.append(b"batch3")
+
+        self.assertEqual([2, 3], spool._segments(s.directory))
+        _crash(s)
+
+        upload = MagicMock(name="upload")
+        resend(self.root, upload)
+
+        upload.assert_called_once_with(b"batch3", "builds/test/test_sessions/1")
+
+    def test_resend_ignores_torn_write(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        s.append(b"batch1")
+        s._file.write(spool._HEADER.pack(100) + b"partial")
+        _crash(s)
+
+        upload = MagicMock(name="upload")
+        resend(self.root, upload)
+
+        upload.assert_called_once_with(b"batch1", "builds/test/test_sessions/1")
+
+    @unittest.skipUnless(spool.LOCKING_SUPPORTED, "requires file locks")
+    def test_resend_skips_live_spool(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        s.append(b"batch1")
+
+        upload = MagicMock(name="upload")
+        self.assertEqual(0, resend(self.root, upload))
+        upload.assert_not_called()
+
+        s.close()
+
+    def test_append_after_close(self):
+        s = Spool.create(self.root, "builds/test/test_sessions/1")
+        record = s.append(b"batch1")
+        s.close()
+
+        # A sender left running after join() gave up does not write to the closed spool
+        self.assertIsNone(s.append(b"batch2"))
+        s.ack(record)
+        self.assertEqual(1, len(os.listdir(self.root)))
+
+    def test_resend_removes_stale_tmp(self):
+        stale = os.path.join(self.root, ".stale")
+        fresh = os.path.join(self.root, ".fresh")
+        os.makedirs(stale)
+        os.makedirs(fresh)
+        os.utime(stale, (0, 0))
+
+        self.assertEqual(0, resend(self.root, MagicMock(name="upload")))
+        self.assertEqual([".fresh"], os.listdir(self.root))
@@ -0,0 +1,88 @@
+import email.utils
+import unittest
+from time import time
+from unittest.mock import MagicMock
+
+from requests.exceptions import ConnectionError, HTTPError
+
+from nose_launchable.throttle import AdaptiveThrottle, parse_retry_after, retry_delay
+
+
+def _http_error(status_code, headers=None):
+    response = MagicMock(name="response")
+    response.status_code = status_code
+    response.headers = headers or {}
+    return HTTPError(response=response)
+
+
+class TestAdaptiveThrottle(unittest.TestCase):
+    def test_on_throttled_halves_batch_size_and_concurrency(self):
+        throttle = AdaptiveThrottle(500, 4)
+
+        throttle.on_throttled(0)
+
+        self.assertEqual(250, throttle.batch_size)
+        self.assertEqual(2, throttle.concurrency)
+
+        for _ in range(10):
+            throttle.on_throttled(0)
+
+        self.assertEqual(1, throttle.batch_size)
+        self.assertEqual(1, throttle.concurrency)
+
+    def test_on_success_grows_back_to_the_limits(self):
+        throttle = AdaptiveThrottle(500, 4)
+        throttle.on_throttled(0)
+
+        throttle.on_success(0.1)
+
+        self.assertEqual(300, throttle.batch_size)
+        self.assertEqual(3, throttle.concurrency)
+
+        for _ in range(10):
+            throttle.on_success(0.1)
+
+        self.assertEqual(500, throttle.batch_size)
+        self.assertEqual(4, throttle.concurrency)
+
+    def test_on_success_slow_response(self):
+        throttle = AdaptiveThrottle(500, 4)
+        throttle.on_throttled(0)
+
+        throttle.on_success(10)
+
+        self.assertEqual(250, throttle.batch_size)
+        self.assertEqual(2, throttle.concurrency)
+
+    def test_pause(self):
+        throttle = AdaptiveThrottle(500, 4)
+        self.assertEqual(0, throttle.pause())
+
+        throttle.on_throttled(10)
+        self.assertGreater(throttle.pause(), 9)
+
+
+class TestRetryDelay(unittest.TestCase):
+    def test_retry_after(self):
+        self.assertEqual(7, retry_delay(_http_error(429, {"Retry-After": "7"}), 0))
+
+    def test_retry_after_capped(self):
+        self.assertEqual(60, retry_delay(_http_error(429, {"Retry-After": "3600"}), 0))
+        self.assertEqual(5, retry_delay(_http_error(503, {"Retry-After": "3600"}), 0, max_backoff=5))
+        self.assertEqual(5, retry_delay(_http_error(503), 10, max_backoff=5))
+
+    def test_backoff(self):
+        self.assertEqual(2, retry_delay(_http_error(503), 0))
+        self.assertEqual(8, retry_delay(_http_error(503), 2))
+        self.assertEqual(4, retry_delay(ConnectionError(), 1))
+
+    def test_not_retryable(self):
+        self.assertIsNone(retry_delay(_http_error(400), 0))
+        self.assertIsNone(retry_delay(Exception(), 0))
+
+    def test_parse_retry_after_date(self):
+        value = email.utils.formatdate(time() + 30, usegmt=True)
+
+        self.assertAlmostEqual(30, parse_retry_after(value), delta=2)
+        self.assertIsNone(parse_retry_after("invalid"))
+        self.assertIsNone(parse_retry_after(None))
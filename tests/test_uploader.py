@@ -1,8 +1,20 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
+from unittest import mock
 from unittest.mock import MagicMock
 
-from nose_launchable.uploader import UploaderFactory, Uploader
-from time import sleep
+from requests.exceptions import HTTPError
+
+from nose_launchable.capture import SpillBuffer, SpilledOutput
+from nose_launchable.case_event import CaseEvent
+from nose_launchable.spool import resend
+from nose_launchable.test_path_component import TestPathComponent
+from nose_launchable.serializer import BATCH_OVERHEAD, encode_event, serialize_events
+from nose_launchable.uploader import UploaderFactory, Uploader, TRUNCATED_MARKER
+from time import sleep, monotonic
 
 
 class TestUploaderFactory(unittest.TestCase):
@@ -11,6 +23,21 @@ class TestUploaderFactory(unittest.TestCase):
         uploader = UploaderFactory.prepare(client)
 
         self.assertEqual(uploader.client, client)
+        self.assertEqual(UploaderFactory.DEFAULT_CONCURRENCY, uploader.concurrency)
+        self.assertEqual(UploaderFactory.DEFAULT_TIMEOUT, uploader.timeout)
+
+    @mock.patch.dict(os.environ, {"LAUNCHABLE_UPLOAD_CONCURRENCY": "8"})
+    def test_prepare_with_concurrency(self):
+        uploader = UploaderFactory.prepare(MagicMock(name="client"))
+
+        self.assertEqual(8, uploader.concurrency)
+
+    @mock.patch.dict(os.environ, {"LAUNCHABLE_MAX_BATCH_SIZE": "100", "LAUNCHABLE_MAX_BATCH_BYTES": "1024"})
+    def test_prepare_with_batch_limits(self):
+        uploader = UploaderFactory.prepare(MagicMock(name="client"))
+
+        self.assertEqual(100, uploader.max_batch_size)
+        self.assertEqual(1024, uploader.max_batch_bytes)
 
 
 def _extract_args(m):
@@ -123,11 +150,302 @@ class TestUploader(unittest.TestCase):
         for f in failures:
             uploader.enqueue_failure(f)
 
-        # send half of events
+        # full batches are sent without waiting for the interval
+        sleep(0.2)
+
+        self.assertEqual(["f1", "f2", "f3", "f4", "f5", "f6", "s1", "s2", "s3", "s4", "s5", "s6"], sorted(_extract_args(client.upload_events)))
+        self.assertEqual([3, 3, 3, 3], [len(c[0][0]) for c in client.upload_events.call_args_list])
+
+        uploader.join()
+
+    def test_integration_enqueue_full_batch_before_interval(self):
+        client = MagicMock(name="client")
+
+        uploader = Uploader(client, 10, 10, 3)
+        uploader.start()
+
+        for s in ["s1", "s2", "s3", "s4"]:
+            uploader.enqueue_success(s)
+
         sleep(0.2)
 
+        self.assertEqual(["s1", "s2", "s3"], _extract_args(client.upload_events))
+
+        uploader.join()
+
+        self.assertEqual(["s1", "s2", "s3", "s4"], _extract_args(client.upload_events))
+
+    def test_join_flushes_without_waiting_for_interval(self):
+        client = MagicMock(name="client")
+
+        uploader = Uploader(client, 10, 10)
+        uploader.start()
+
+        uploader.enqueue_success("s1")
+        uploader.enqueue_failure("f1")
+
+        started = monotonic()
+        uploader.join()
+
+        self.assertLess(monotonic() - started, 1)
+        self.assertEqual(["f1", "s1"], sorted(_extract_args(client.upload_events)))
+
+    def _slow_client(self):
+        client = MagicMock(name="client")
+        lock = threading.Lock()
+        client.in_flight = 0
+        client.max_in_flight = 0
+
+        def upload_events(events):
+            with lock:
+                client.in_flight += 1
+                client.max_in_flight = max(client.max_in_flight, client.in_flight)
+            sleep(0.1)
+            with lock:
+                client.in_flight -= 1
+
+        client.upload_events.side_effect = upload_events
+        return client
+
+    def test_concurrent_uploads(self):
+        client = self._slow_client()
+
+        uploader = Uploader(client, 10, 10, 1, concurrency=3)
+        uploader.start()
+
+        for s in ["s1", "s2", "s3", "s4", "s5", "s6"]:
+            uploader.enqueue_success(s)
+
+        uploader.join()
+
+        self.assertEqual(["s1", "s2", "s3", "s4", "s5", "s6"], sorted(_extract_args(client.upload_events)))
+        self.assertEqual(3, client.max_in_flight)
+
+    def test_uploads_are_bounded_by_concurrency(self):
+        client = self._slow_client()
+
+        uploader = Uploader(client, 10, 10, 1)
+        uploader.start()
+
+        for s in ["s1", "s2", "s3"]:
+            uploader.enqueue_success(s)
+        for f in ["f1", "f2", "f3"]:
+            uploader.enqueue_failure(f)
+
+        uploader.join()
+
         self.assertEqual(["f1", "f2", "f3", "s1", "s2", "s3"], sorted(_extract_args(client.upload_events)))
+        self.assertEqual(1, client.max_in_flight)
+
+    def _event(self, name, stdout=""):
+        return CaseEvent([TestPathComponent(TestPathComponent.FILE_TYPE, name)], 0.1, CaseEvent.TEST_PASSED, stdout, "")
+
+    def test_integration_enqueue_byte_budget(self):
+        client = MagicMock(name="client")
+
+        events = [self._event("test{}.py".format(i), "x" * 100) for i in range(6)]
+        # Room for two events per batch
+        budget = BATCH_OVERHEAD + 2 * (len(encode_event(events[0])) + 1)
+
+        uploader = Uploader(client, 10, 10, max_batch_bytes=budget)
+        uploader.start()
+
+        for e in events:
+            uploader.enqueue_success(e)
 
         uploader.join()
 
-        self.assertEqual(["f1", "f2", "f3", "f4", "f5", "f6", "s1", "s2", "s3", "s4", "s5", "s6"], sorted(_extract_args(client.upload_events)))
+        self.assertEqual(events, _extract_args(client.upload_events))
+        self.assertEqual([2, 2, 2], [len(c[0][0]) for c in client.upload_events.call_args_list])
+        for c in client.upload_events.call_args_list:
+            self.assertLessEqual(len(serialize_events(c[0][0])), budget)
+
+    def test_integration_enqueue_oversized_event(self):
+        client = MagicMock(name="client")
+
+        small = self._event("test1.py")
+        large = self._event("test2.py", "head" + "x" * 10000)
+        budget = 1024
+
+        uploader = Uploader(client, 10, 10, max_batch_bytes=budget)
+        uploader.start()
+
+        uploader.enqueue_success(small)
+        uploader.enqueue_success(large)
+
+        uploader.join()
+
+        self.assertEqual([small, large], _extract_args(client.upload_events))
+        self.assertTrue(large.stdout.startswith("head"))
+        self.assertTrue(large.stdout.endswith(TRUNCATED_MARKER))
+        for c in client.upload_events.call_args_list:
+            self.assertLessEqual(len(serialize_events(c[0][0])), budget)
+
+    def test_integration_retry_throttled_upload(self):
+        client = MagicMock(name="client")
+        response = MagicMock(name="response")
+        response.status_code = 429
+        response.headers = {"Retry-After": "0.1"}
+        client.upload_events.side_effect = [HTTPError(response=response), None]
+
+        uploader = Uploader(client, 10, 10, 4)
+        uploader.start()
+
+        for s in ["s1", "s2"]:
+            uploader.enqueue_success(s)
+
+        uploader.join()
+
+        self.assertEqual(2, client.upload_events.call_count)
+        self.assertEqual(["s1", "s2"], client.upload_events.call_args[0][0])
+        # Halved to 2 by the 429, then grown by one step by the fast retry
+        self.assertEqual(3, uploader.throttle.batch_size)
+
+    def test_retry_after_bounded_before_join(self):
+        client = MagicMock(name="client")
+        response = MagicMock(name="response")
+        response.status_code = 429
+        response.headers = {"Retry-After": "3600"}
+        client.upload_events.side_effect = [HTTPError(response=response), None]
+
+        # Capped to 0.1 seconds, and then the retry is sent
+        uploader = Uploader(client, 0.01, 0.01, timeout=5, max_backoff=0.1)
+        uploader.start()
+        uploader.enqueue_success("s1")
+        sleep(0.5)
+        self.assertEqual(2, client.upload_events.call_count)
+        uploader.join()
+
+        # Longer than join() would wait, so it is not retried
+        client.upload_events.reset_mock()
+        client.upload_events.side_effect = HTTPError(response=response)
+        uploader = Uploader(client, 0.01, 0.01, timeout=0.5)
+        uploader.start()
+        uploader.enqueue_success("s1")
+        sleep(0.3)
+        self.assertEqual(1, client.upload_events.call_count)
+        self.assertEqual(0, uploader.throttle.pause())
+        uploader.join()
+
+    def test_join_gives_up_after_timeout(self):
+        client = MagicMock(name="client")
+        response = MagicMock(name="response")
+        response.status_code = 503
+        response.headers = {}
+        client.upload_events.side_effect = HTTPError(response=response)
+
+        uploader = Uploader(client, 10, 10, timeout=0.5)
+        uploader.start()
+
+        uploader.enqueue_success("s1")
+
+        started = monotonic()
+        uploader.join()
+
+        self.assertLess(monotonic() - started, 1.5)
+
+    def test_integration_enqueue_oversized_spilled_event(self):
+        client = MagicMock(name="client")
+
+        buffer = SpillBuffer(1)
+        buffer.write("head" + "x" * 10000)
+        large = self._event("test1.py", buffer.getvalue())
+        budget = 1024
+
+        uploader = Uploader(client, 10, 10, max_batch_bytes=budget)
+        uploader.start()
+        uploader.enqueue_success(large)
+        uploader.join()
+
+        self.assertTrue(large.stdout.startswith("head"))
+        self.assertTrue(large.stdout.endswith(TRUNCATED_MARKER))
+        self.assertLessEqual(len(serialize_events([large])), budget)
+
+
+    def test_spilled_event_is_cut_before_encoding(self):
+        client = MagicMock(name="client")
+
+        buffer = SpillBuffer(1)
+        buffer.write("head" + "x" * 100000)
+        output = buffer.getvalue()
+        large = self._event("test1.py", output)
+
+        uploader = Uploader(client, 10, 10, max_batch_bytes=1024)
+        with mock.patch.object(SpilledOutput, "chunks", side_effect=AssertionError("read whole")):
+            uploader._size(large)
+
+        self.assertTrue(large.stdout.startswith("head"))
+        self.assertTrue(large.stdout.endswith(TRUNCATED_MARKER))
+        # Released once cut
+        self.assertTrue(output._file.closed)
+
+    def test_small_spilled_event_is_released_once_encoded(self):
+        buffer = SpillBuffer(1)
+        buffer.write("spilled")
+        output = buffer.getvalue()
+        event = self._event("test1.py", output)
+
+        uploader = Uploader(MagicMock(name="client"), 10, 10, max_batch_bytes=1024)
+        uploader._size(event)
+
+        self.assertTrue(output._file.closed)
+        self.assertIn(b'"stdout":"spilled"', serialize_events([event]))
+
+
+class TestUploaderWithSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _client(self):
+        client = MagicMock(name="client")
+        client.test_session_context.get_session.return_value = "builds/test/test_sessions/1"
+        return client
+
+    def _event(self, name):
+        return CaseEvent([TestPathComponent(TestPathComponent.FILE_TYPE, name)], 0.1, CaseEvent.TEST_PASSED, "", "")
+
+    def test_upload_through_spool(self):
+        client = self._client()
+
+        uploader = Uploader(client, 0.1, 0.1, spool_dir=self.tmp.name)
+        uploader.start()
+        uploader.enqueue_success(self._event("test1.py"))
+        uploader.join()
+
+        payload, = client.upload_payload.call_args[0]
+        self.assertEqual("test1.py", json.loads(payload.decode("utf-8"))["events"][0]["testPath"][0]["name"])
+        self.assertEqual([], os.listdir(self.tmp.name))
+
+    def test_failed_upload_is_kept_and_resent(self):
+        client = self._client()
+        client.upload_payload.side_effect = Exception("API is down")
+
+        uploader = Uploader(client, 0.1, 0.1, spool_dir=self.tmp.name)
+        uploader.start()
+        uploader.enqueue_success(self._event("test1.py"))
+        uploader.enqueue_failure(self._event("test2.py"))
+        uploader.join()
+
+        self.assertEqual(1, len(os.listdir(self.tmp.name)))
+
+        upload = MagicMock(name="upload")
+        self.assertEqual(2, resend(self.tmp.name, upload))
+        self.assertEqual([], os.listdir(self.tmp.name))
+
+    def test_join_keeps_spool_open_for_running_senders(self):
+        client = self._client()
+        release = threading.Event()
+        client.upload_payload.side_effect = lambda payload: release.wait(5)
+
+        uploader = Uploader(client, 0.01, 0.01, spool_dir=self.tmp.name, timeout=0.2)
+        uploader.start()
+        uploader.enqueue_success(self._event("test1.py"))
+        sleep(0.1)
+        uploader.join()
+
+        self.assertFalse(uploader.spool._closed)
+        self.assertEqual(1, len(os.listdir(self.tmp.name)))
+        release.set()